@@ -0,0 +1,185 @@
+import multiprocessing
+import resource
+import time
+import torch
+
+import Train
+import Train_Chinese
+from Utils import logger
+
+def timed_run(trainer, batch_size, num_sentences = None):
+    '''
+    run the whole tagger (embeddings, encoder and decoding) on the test set
+    output:
+        tokens, sentences, seconds
+    '''
+    model = trainer.model
+    model.eval()
+    num_sentences = len(trainer.test_set) if num_sentences is None else min(num_sentences, len(trainer.test_set))
+    tokens = 0
+    start = time.time()
+    with torch.no_grad():
+        for i in range(0, num_sentences, batch_size):
+            batch = trainer.test_set[i: min(i + batch_size, num_sentences)]
+            if len(batch) == 5: # CoNLL
+                text, word_ids, char_ids, tag_ids, word_mask = batch
+                sen_len = torch.max(torch.sum(word_mask, dim = 1, dtype = torch.int64)).item()
+                word_mask = word_mask[:, : sen_len].to(trainer.device)
+                model(text, word_ids[:, : sen_len].to(trainer.device), word_mask, char_ids[:, : sen_len, :].to(trainer.device), None)
+                tokens += torch.sum(word_mask).item()
+            else: # CCKS
+                text, char_ids, char_mask, tag_ids = batch
+                sen_len = max([len(sentence) for sentence in text])
+                char_mask = char_mask[:, : sen_len].to(trainer.device)
+                model(text, None, None, char_ids[:, : sen_len].to(trainer.device), char_mask)
+                tokens += torch.sum(char_mask).item()
+    if trainer.device == 'cuda':
+        torch.cuda.synchronize()
+    return tokens, num_sentences, time.time() - start
+
+def throughput(trainer):
+    '''
+    tokens per second of the whole tagger on the test set
+    '''
+    tokens, _, seconds = timed_run(trainer, trainer.batch_size)
+    return tokens / seconds
+
+def latency(trainer, num_sentences = 200):
+    '''
+    milliseconds per sentence of the whole tagger with batch_size = 1, on the first num_sentences of the test set
+    '''
+    _, sentences, seconds = timed_run(trainer, 1, num_sentences)
+    return seconds / sentences * 1000
+
+def step_memory(model, inputs):
+    '''
+    run one training step, model(*inputs) returns the loss
+    output:
+        saved_bytes: bytes of the activations kept for backward, parameters excluded
+        peak_bytes: peak allocated cuda memory of the step, 0 on CPU
+    '''
+    parameters = set(parameter.data_ptr() for parameter in model.parameters())
+    saved = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    cuda = next(model.parameters()).is_cuda
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    model.train()
+    model.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = model(*inputs)
+    loss.backward()
+    peak_bytes = torch.cuda.max_memory_allocated() if cuda else 0
+    model.zero_grad()
+    return sum(saved.values()), peak_bytes
+
+def resident_bytes():
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def forked_step_memory(model, inputs, connection):
+    '''
+    step_memory in a forked process, the peak resident memory of a fresh process starts at its current size
+    '''
+    resident = resident_bytes()
+    saved_bytes, _ = step_memory(model, inputs)
+    peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+    connection.send((saved_bytes, peak_bytes, peak_bytes - resident))
+    connection.close()
+
+def training_memory(model, inputs):
+    '''
+    memory of one training step, model(*inputs) returns the loss
+    on CPU the step runs in a forked process, so that its peak resident memory is not hidden by earlier peaks of this process
+    output:
+        saved_bytes: bytes of the activations kept for backward, parameters excluded
+        peak_bytes: peak allocated cuda memory (GPU) or peak resident memory of the process (CPU)
+        step_bytes: peak_bytes above the memory in use before the step
+    '''
+    if next(model.parameters()).is_cuda:
+        torch.cuda.synchronize()
+        allocated = torch.cuda.memory_allocated()
+        saved_bytes, peak_bytes = step_memory(model, inputs)
+        return saved_bytes, peak_bytes, peak_bytes - allocated
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex = False)
+    process = context.Process(target = forked_step_memory, args = (model, inputs, sender))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+def compare_checkpoint(trainer, batch_size = 32, sen_len = 256):
+    '''
+    memory of one training step on the first batch_size training sentences, with and without use_checkpoint
+    output:
+        results: {use_checkpoint: (saved_bytes, peak_bytes, step_bytes)}, see training_memory
+    sen_len: CCKS sentences are repeated up to sen_len, e.g. above the max_sen_len of the dataset, to test longer inputs
+    '''
+    model = trainer.model
+    batch = trainer.train_set[: batch_size]
+    if len(batch) == 5: # CoNLL
+        text, word_ids, char_ids, tag_ids, word_mask = batch
+        sen_len = torch.max(torch.sum(word_mask, dim = 1, dtype = torch.int64)).item()
+        inputs = (text, word_ids[:, : sen_len].to(trainer.device), word_mask[:, : sen_len].to(trainer.device),
+                  char_ids[:, : sen_len, :].to(trainer.device), None, tag_ids[:, : sen_len].to(trainer.device))
+    else: # CCKS, repeat each sentence up to sen_len
+        text, char_ids, char_mask, tag_ids = batch
+        lengths = char_mask.sum(1)
+        index = torch.arange(sen_len).view(1, -1) % lengths.view(-1, 1)
+        text = [(sentence * (sen_len // len(sentence) + 1))[: sen_len] for sentence in text]
+        char_ids, tag_ids = char_ids.gather(1, index), tag_ids.gather(1, index)
+        char_mask = torch.ones(len(text), sen_len, dtype = torch.bool)
+        inputs = (text, None, None, char_ids.to(trainer.device), char_mask.to(trainer.device), tag_ids.to(trainer.device))
+    use_checkpoint = model.use_checkpoint
+    results = {}
+    for flag in (False, True):
+        model.use_checkpoint = flag
+        results[flag] = training_memory(model, inputs)
+        logger('[Memory] use_checkpoint = {}: saved activations: {:.1f} MB, {} peak: {:.1f} MB, step: {:.1f} MB'.format(
+            flag, results[flag][0] / 1024 / 1024, 'cuda' if trainer.device == 'cuda' else 'RSS',
+            results[flag][1] / 1024 / 1024, results[flag][2] / 1024 / 1024))
+    model.use_checkpoint = use_checkpoint
+    return results
+
+def compare_encoders(build_trainer, encoders = ('bilstm', 'idcnn')):
+    '''
+    build_trainer: encoder -> trained Trainer
+    output:
+        results: {encoder: (tokens per second, f1)}
+    '''
+    results = {}
+    for encoder in encoders:
+        trainer = build_trainer(encoder)
+        f1 = trainer.test()['f1']
+        results[encoder] = (throughput(trainer), f1)
+    for encoder, (speed, f1) in results.items():
+        logger('[Benchmark] encoder: {}, throughput: {:.1f} tokens/s, F1: {:.8f}'.format(encoder, speed, f1))
+    return results
+
+def conll_trainer(encoder, data_path = './data_small/', epochs = 100):
+    trainer = Train.Trainer(mod = 'train', model_time = None, data_path = data_path, epochs = epochs,
+        use_word = True, use_char = True, use_lm = False, use_crf = True,
+        use_pretrained_word = True, use_pretrained_char = False,
+        attention_pooling = False, encoder = encoder)
+    trainer.train()
+    return trainer
+
+def ccks_trainer(encoder, data_path = '/data/CCKS2019/', epochs = 100):
+    # Train_Chinese.Trainer trains in __init__
+    return Train_Chinese.Trainer('train', None, data_path, epochs = epochs,
+        use_word = False, use_char = True, use_lm = False, use_crf = True, use_lexicon = False,
+        use_pretrained_word = False, use_pretrained_char = False,
+        attention_pooling = False, encoder = encoder)
+
+if __name__ == '__main__':
+    logger('CoNLL2003:')
+    compare_encoders(conll_trainer)
+    logger('CCKS2019:')
+    compare_encoders(ccks_trainer)
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 
 from crf import CRF
 from Utils import logger
@@ -49,3 +49,54 @@ class BiLSTM(nn.Module):
         lstm_feats = self.dropout2(lstm_feats)
 
         return lstm_feats
+
+    def forward_packed(self, embeds, word_mask):
+        '''
+        like forward, but the output stays packed, dropout and hidden2tag only run on real tokens
+        input:
+            embeds:     (batch_size, sen_len, emb_size)
+            word_mask:  (batch_size, sen_len)
+        output:
+            lstm_feats: PackedSequence of (num_tokens, tagset_size)
+        '''
+        sen_len = torch.sum(word_mask, dim = 1, dtype = torch.int64).to('cpu') # (batch_size)
+        pack_seq = pack_padded_sequence(embeds, sen_len, batch_first = True, enforce_sorted = False)
+        pack_seq = PackedSequence(self.dropout1(pack_seq.data), pack_seq.batch_sizes, pack_seq.sorted_indices, pack_seq.unsorted_indices)
+        lstm_out, _ = self.lstm(pack_seq)
+        lstm_feats = self.dropout2(self.hidden2tag(lstm_out.data)) # (num_tokens, tagset_size)
+        return PackedSequence(lstm_feats, lstm_out.batch_sizes, lstm_out.sorted_indices, lstm_out.unsorted_indices)
+
+    def forward_padded(self, embeds, word_mask):
+        '''
+        like forward, without packing: packed sequences miss the fused CPU lstm kernel
+        the backward direction reads every sentence reversed within its length,
+        so the outputs of real tokens are the same as forward and padded tokens are zero
+        input:
+            embeds:     (batch_size, sen_len, emb_size)
+            word_mask:  (batch_size, sen_len)
+        output:
+            lstm_feats: (batch_size, sen_len, tagset_size)
+        '''
+        embeds = self.dropout1(embeds)
+        batch_size, sen_len, _ = embeds.shape
+        lengths = torch.sum(word_mask, dim = 1, dtype = torch.int64).view(-1, 1)
+        steps = torch.arange(sen_len, device = embeds.device).view(1, -1)
+        reverse_index = torch.where(steps < lengths, lengths - 1 - steps, steps).unsqueeze(2) # (batch_size, sen_len, 1)
+        weights = self.lstm.all_weights # [w_ih, w_hh, b_ih, b_hh] of l0, l0_reverse, l1, ...
+        h0 = embeds.new_zeros(1, batch_size, self.lstm.hidden_size)
+        lstm_out = embeds
+        for layer in range(self.lstm.num_layers):
+            outputs = []
+            for direction in range(2):
+                inputs = lstm_out
+                if direction == 1:
+                    inputs = inputs.gather(1, reverse_index.expand(-1, -1, inputs.size(2)))
+                output, _, _ = torch.lstm(inputs, (h0, h0), weights[2 * layer + direction], True, 1, 0.0, self.training, False, True)
+                if direction == 1:
+                    output = output.gather(1, reverse_index.expand(-1, -1, output.size(2)))
+                outputs.append(output)
+            lstm_out = torch.cat(outputs, dim = 2)
+        lstm_out = lstm_out * word_mask.unsqueeze(2).to(lstm_out.dtype) # as pad_packed_sequence
+        lstm_feats = self.hidden2tag(lstm_out)
+        lstm_feats = self.dropout2(lstm_feats)
+        return lstm_feats
@@ -1,8 +1,12 @@
 import sys
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 from BiLSTM import BiLSTM
+from IDCNN import IDCNN
+from TensorTagger import TensorTagger
 
 from crf import CRF
 from CharEmbedding import CharEmbedding
@@ -17,7 +21,8 @@ class BiLSTM_CRF(nn.Module):
             batch_size, device, dropout = 0.5, 
             use_word = True, use_char = True, use_lm = True, use_crf = True, use_cnn = True, use_lexicon = True,
             use_pretrained_word = True, use_pretrained_char = True, 
-            attention_pooling = False):
+            attention_pooling = False, crf_engine = 'loop', crf_bypass = False, bypass_margin = None, encoder = 'bilstm', use_packed = False, use_checkpoint = False,
+            use_compile = False, compile_bucket = 32, lm_cache_dir = None, lm_shared_dir = None):
         super().__init__()
         self.word_vocab = word_vocab
         self.tag_vocab = tag_vocab
@@ -40,6 +45,17 @@ class BiLSTM_CRF(nn.Module):
         self.use_cnn = use_cnn
         self.use_crf = use_crf
         self.attention_pooling = attention_pooling
+        self.encoder = encoder # 'bilstm' or 'idcnn'
+        self.use_packed = use_packed # padding-free emissions and crf for the bilstm encoder
+        self.use_checkpoint = use_checkpoint # recompute embeddings and encoder in backward to save memory
+        self.use_compile = use_compile # run embeddings, encoder and crf through torch.compile, see _compiled_forward
+        self.compile_bucket = compile_bucket # sen_len is padded to a multiple of compile_bucket to bound recompilation
+        self.compiled_steps = {} # steps of this model compiled by _compiled_forward, torch.compile caches their graphs by shape
+        self.crf_engine = crf_engine # 'loop', 'scan', 'sparse' or 'fused', see crf.CRF
+        self.crf_bypass = crf_bypass # take the argmax path of confident sentences at inference, see crf.CRF.gated_viterbi_tags
+        self.bypass_margin = bypass_margin
+        self.bypass_count = 0
+        self.decode_count = 0
         
         # self.word_emb_dim = word_emb_dim
         # self.char_emb_dim = char_emb_dim
@@ -48,11 +64,8 @@ class BiLSTM_CRF(nn.Module):
         self.emb_dim = emb_dim # lstm input dim
         self.raw_emb_dim = 0 # emb_dim after concat
         if use_word:
-            if use_pretrained_word:
-                self.word_emb_dim = word_vocab.word_emb.shape[1]
-            else:
-                self.word_emb_dim = char_emb_dim
-            self.word_embeds = WordEmbedding(word_vocab, self.word_emb_dim, use_pretrained_word, self.fine_tune_word)
+            # pretrained word embeddings keep the dim of the pretrained table
+            self.word_embeds = WordEmbedding(word_vocab, char_emb_dim, use_pretrained_word, self.fine_tune_word)
             self.word_emb_dim = self.word_embeds.get_emb_dim()
             self.raw_emb_dim += self.word_emb_dim
         else:
@@ -66,7 +79,7 @@ class BiLSTM_CRF(nn.Module):
             self.char_emb_dim = 0
         
         if use_lm:
-            self.lm_embeds = LMEmbedding(lm_emb_dim)
+            self.lm_embeds = LMEmbedding(lm_emb_dim, cache_dir = lm_cache_dir, shared_dir = lm_shared_dir)
             self.lm_emb_dim = self.lm_embeds.get_emb_dim()
             self.raw_emb_dim += self.lm_emb_dim
         else:
@@ -85,9 +98,14 @@ class BiLSTM_CRF(nn.Module):
         #     self.emb_dim = self.raw_emb_dim
         self.emb_dim = self.raw_emb_dim
         
-        self.bilstm = BiLSTM(
-            word_vocab, tag_vocab, self.emb_dim, self.hidden_dim, num_layers, dropout
-            )
+        if encoder == 'idcnn':
+            self.idcnn = IDCNN(
+                word_vocab, tag_vocab, self.emb_dim, self.hidden_dim, num_layers, dropout
+                )
+        else:
+            self.bilstm = BiLSTM(
+                word_vocab, tag_vocab, self.emb_dim, self.hidden_dim, num_layers, dropout
+                )
         if use_crf:
             tag_dict = {value: key for key, value in self.tag_vocab.tag_to_ix.items()}
             self.crf = CRF(tag_dict)
@@ -97,19 +115,13 @@ class BiLSTM_CRF(nn.Module):
         ))
 
     
-    def forward(self, text, word_ids, word_mask, char_ids, char_mask, label = None): # (batch_size, sen_len)
+    def _get_embeds(self, text, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids = None, lm_embeds = None):
         '''
-        input:
-            dim == 3: (English NER)
-                text:   list(list)
-                word_ids:   (batch_size, sen_len)
-                word_mask:  (batch_size, sen_len)
-                char_ids:   (batch_size, sen_len, max_word_len)
-                label:      (batch_size, sen_len)
-            dim == 2: (Chinese NER)
-                text:   list(list)
-                char_ids:   (batch_size, sen_len)
-                char_mask:  (batch_size, sen_len)
+        lexicon_type_ids: (batch_size, sen_len), lexicon type ids of text if already computed
+        lm_embeds: (batch_size, sen_len, lm_emb_dim), output of lm_embeds if already computed
+        output:
+            embeds:     (batch_size, sen_len, emb_dim)
+            word_mask:  (batch_size, sen_len)
         '''
         embeds = None
         if self.use_word:
@@ -124,14 +136,15 @@ class BiLSTM_CRF(nn.Module):
                 embeds = torch.cat((embeds, char_emb), dim = -1)
         
         if self.use_lm:
-            lm_embeds = self.lm_embeds(text) # (batch_size, sen_len, 256)
+            if lm_embeds is None:
+                lm_embeds = self.lm_embeds(text) # (batch_size, sen_len, 256)
             if embeds is None:
                 embeds = lm_embeds
             else:
                 embeds = torch.cat((embeds, lm_embeds), dim = -1)
         
         if self.use_lexicon:
-            lexicon_embeds = self.lexicon_embeds(text) # (batch_size, sen_len, 256)
+            lexicon_embeds = self.lexicon_embeds(text, lexicon_type_ids) # (batch_size, sen_len, 256)
             if embeds is None:
                 embeds = lexicon_embeds
             else:
@@ -142,17 +155,214 @@ class BiLSTM_CRF(nn.Module):
         
         if self.use_char and char_ids.dim() == 2: # no word embedding
             word_mask = char_mask
-        
-        lstm_out = self.bilstm(embeds, word_mask, label)
+        return embeds, word_mask
+
+    def _encode(self, embeds, word_mask, label = None, packed = False):
+        if packed:
+            return self.bilstm.forward_packed(embeds, word_mask)
+        if self.encoder == 'idcnn':
+            return self.idcnn(embeds, word_mask, label)
+        return self.bilstm(embeds, word_mask, label)
+
+    def _get_emissions(self, text, word_ids, word_mask, char_ids, char_mask, label = None, lexicon_type_ids = None, packed = False):
+        '''
+        lexicon_type_ids: (batch_size, sen_len), lexicon type ids of text if already computed
+        packed: return a PackedSequence, see BiLSTM.forward_packed
+        output:
+            lstm_out:   (batch_size, sen_len, tagset_size)
+            word_mask:  (batch_size, sen_len)
+        '''
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return self._get_emissions_checkpointed(text, word_ids, word_mask, char_ids, char_mask, label, lexicon_type_ids, packed)
+        embeds, word_mask = self._get_embeds(text, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids)
+        return self._encode(embeds, word_mask, label, packed), word_mask
+
+    def _get_emissions_checkpointed(self, text, word_ids, word_mask, char_ids, char_mask, label, lexicon_type_ids, packed):
+        '''
+        the activations of the trainable embeddings and the encoder are recomputed in backward instead of kept,
+        the frozen LM and the lexicon lookup run outside the checkpoint
+        '''
+        lm_embeds = self.lm_embeds(text) if self.use_lm else None
+        if self.use_lexicon and lexicon_type_ids is None:
+            lexicon_type_ids = torch.as_tensor(self.lexicon_embeds.lexicon_vocab.map_batch_to_typeid(text), dtype = torch.long)
+
+        def segment(word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds):
+            embeds, word_mask = self._get_embeds(text, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds)
+            return self._encode(embeds, word_mask, label, packed), word_mask
+
+        return checkpoint(segment, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds, use_reentrant = False)
+
+    @torch.compiler.disable
+    def _eager_encode(self, embeds, word_mask):
+        '''
+        the bilstm runs eagerly between the compiled graphs, inductor decomposes nn.LSTM into per-timestep ops,
+        which train slower than the fused kernel
+        '''
+        return self.bilstm.forward_padded(embeds, word_mask)
+
+    def _tensor_emissions(self, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds):
+        embeds, word_mask = self._get_embeds(None, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds)
+        if self.encoder == 'idcnn':
+            return self.idcnn(embeds, word_mask), word_mask
+        return self._eager_encode(embeds, word_mask), word_mask
+
+    def _loss_step(self, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds, label, row_mask):
+        '''
+        tensor-only crf loss for torch.compile with crf_engine, the timestep loops are unrolled for the padded sen_len
+        row_mask: (batch_size), 0 for the rows padding the batch
+        '''
+        lstm_out, word_mask = self._tensor_emissions(word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds)
+        log_likelihood = self.crf(lstm_out, label, word_mask, self.crf_engine, row_mask)
+        return -log_likelihood / torch.sum(row_mask)
+
+    def _decode_step(self, word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds):
+        '''
+        tensor-only inference for torch.compile with crf_engine, predict if use_crf, otherwise the emissions
+        '''
+        lstm_out, word_mask = self._tensor_emissions(word_ids, word_mask, char_ids, char_mask, lexicon_type_ids, lm_embeds)
+        if not self.use_crf:
+            return lstm_out
+        return self.crf.viterbi_tags(lstm_out, word_mask, self.crf_engine)
+
+    def __getstate__(self):
+        # copies, e.g. deepcopy in Prune, compile their own steps
+        state = self.__dict__.copy()
+        state['compiled_steps'] = {}
+        return state
+
+    def _compiled_forward(self, text, word_ids, word_mask, char_ids, char_mask, label = None):
+        '''
+        forward through the compiled _loss_step and _decode_step, the bilstm itself runs eagerly, see _eager_encode
+        the LM and the lexicon lookup read text and run eagerly, their outputs are inputs of the compiled step
+        the batch is padded to batch_size and sen_len to a multiple of compile_bucket, so each step is compiled
+        once per sen_len bucket and mode, e.g. 128 / 32 = 4 shapes
+        '''
+        if not self.compiled_steps:
+            self.compiled_steps['loss'] = torch.compile(BiLSTM_CRF._loss_step, dynamic = False)
+            self.compiled_steps['decode'] = torch.compile(BiLSTM_CRF._decode_step, dynamic = False)
+        lm_embeds = self.lm_embeds(text) if self.use_lm else None
+        lexicon_type_ids = None
+        if self.use_lexicon:
+            lexicon_type_ids = torch.as_tensor(self.lexicon_embeds.lexicon_vocab.map_batch_to_typeid(text), dtype = torch.long).to(char_ids.device)
+
+        mask = word_mask if char_ids is None or char_ids.dim() == 3 else char_mask
+        batch_size, sen_len = mask.shape
+        padded_batch_size = max(batch_size, self.batch_size)
+        padded_sen_len = (sen_len + self.compile_bucket - 1) // self.compile_bucket * self.compile_bucket
+        def pad(tensor):
+            if tensor is None:
+                return None
+            padding = [0, 0] * (tensor.dim() - 2) + [0, padded_sen_len - sen_len, 0, padded_batch_size - batch_size]
+            return F.pad(tensor, padding)
+        # padding rows get one real token, so that every row has a valid crf path
+        first_token = (torch.arange(padded_batch_size, device = mask.device) >= batch_size).view(-1, 1)
+        first_token = F.pad(first_token, [0, padded_sen_len - 1])
+        if word_mask is not None:
+            word_mask = pad(word_mask.long()).bool() | first_token
+        if char_mask is not None:
+            char_mask = pad(char_mask.long()).bool() | first_token
+        inputs = (pad(word_ids), word_mask, pad(char_ids), char_mask, pad(lexicon_type_ids), pad(lm_embeds))
+
+        if label is None or not self.use_crf:
+            output = self.compiled_steps['decode'](self, *inputs)
+            return output[: batch_size, : sen_len]
+        row_mask = (torch.arange(padded_batch_size, device = mask.device) < batch_size).float()
+        return self.compiled_steps['loss'](self, *inputs, pad(label), row_mask)
+
+    def forward(self, text, word_ids, word_mask, char_ids, char_mask, label = None): # (batch_size, sen_len)
+        '''
+        input:
+            dim == 3: (English NER)
+                text:   list(list)
+                word_ids:   (batch_size, sen_len)
+                word_mask:  (batch_size, sen_len)
+                char_ids:   (batch_size, sen_len, max_word_len)
+                label:      (batch_size, sen_len)
+            dim == 2: (Chinese NER)
+                text:   list(list)
+                char_ids:   (batch_size, sen_len)
+                char_mask:  (batch_size, sen_len)
+        '''
+        if self.use_packed and self.use_crf and self.encoder == 'bilstm' and not (label is None and self.crf_bypass):
+            # emissions, loss and decoding stay packed, nothing is computed for padding
+            lstm_out, word_mask = self._get_emissions(text, word_ids, word_mask, char_ids, char_mask, packed = True)
+            if label is None:
+                return self.crf.viterbi_tags_packed(lstm_out)
+            batch_size = label.shape[0]
+            return -self.crf.forward_packed(lstm_out, label) / batch_size
+
+        if self.use_compile and not (label is None and self.crf_bypass):
+            return self._compiled_forward(text, word_ids, word_mask, char_ids, char_mask, label)
+
+        lstm_out, word_mask = self._get_emissions(text, word_ids, word_mask, char_ids, char_mask, label)
         
         if not self.use_crf:
             return lstm_out
         else:
             if label is None:
-                predict = self.crf.viterbi_tags(lstm_out, word_mask)
+                if self.crf_bypass:
+                    predict, fast = self.crf.gated_viterbi_tags(lstm_out, word_mask, self.bypass_margin, self.crf_engine)
+                    self.bypass_count += torch.sum(fast).item()
+                    self.decode_count += fast.shape[0]
+                else:
+                    predict = self.crf.viterbi_tags(lstm_out, word_mask, self.crf_engine)
                 return predict
             else:
-                log_likelihood = self.crf(lstm_out, label, word_mask)
+                log_likelihood = self.crf(lstm_out, label, word_mask, self.crf_engine)
                 batch_size = label.shape[0]
                 loss = -log_likelihood / batch_size
                 return loss
+
+    def to_torchscript(self, path = None):
+        '''
+        compile the tensor-only inference path, see TensorTagger
+        path: save the scripted model to path if given, it can be loaded by torch.jit.load without this repo
+        output:
+            scripted: torch.jit.ScriptModule, (word_ids, word_mask, char_ids, char_mask, lexicon_type_ids) -> predict
+        '''
+        self.eval()
+        scripted = torch.jit.script(TensorTagger(self))
+        if path is not None:
+            scripted.save(path)
+        return scripted
+
+    def bypass_ratio(self, reset = True):
+        '''
+        fraction of sentences decoded by the argmax fast path since the last reset
+        '''
+        ratio = self.bypass_count / max(self.decode_count, 1)
+        if reset:
+            self.bypass_count = 0
+            self.decode_count = 0
+        return ratio
+
+    def predict_with_confidence(self, text, word_ids, word_mask, char_ids, char_mask):
+        '''
+        output:
+            predict:    (batch_size, sen_len)
+            marginals:  (batch_size, sen_len, tagset_size), tag marginals of each token
+            confidence: (batch_size, sen_len), confidence of the entity starting at each token
+        '''
+        lstm_out, word_mask = self._get_emissions(text, word_ids, word_mask, char_ids, char_mask)
+        predict = self.crf.viterbi_tags(lstm_out, word_mask, self.crf_engine)
+        marginals = self.crf.marginals(lstm_out, word_mask)
+        confidence = self.crf.entity_confidence(lstm_out, word_mask, predict)
+        return predict, marginals, confidence
+
+    def predict_with_lexicon(self, text, word_ids, word_mask, char_ids, char_mask, lexicon_vocab = None, use_rule = False, force = False):
+        '''
+        decode with lexicon hits, the lexicon is scanned once and shared with the lexicon embedding
+        lexicon_vocab: LexiconVocab, the vocab of lexicon_embeds if None
+        force: lexicon words are forced spans of the CRF path and override the model, plain viterbi if False
+        output:
+            predict:    (batch_size, sen_len)
+        '''
+        if lexicon_vocab is None:
+            lexicon_vocab = self.lexicon_embeds.lexicon_vocab
+        type_ids = torch.tensor(lexicon_vocab.map_batch_to_typeid(text, use_rule), dtype = torch.long, device = self.device)
+        # the embedding shares the lexicon scan when it uses the same words
+        shared = self.use_lexicon and lexicon_vocab is self.lexicon_embeds.lexicon_vocab and not use_rule
+        lstm_out, word_mask = self._get_emissions(text, word_ids, word_mask, char_ids, char_mask,
+                                                  lexicon_type_ids = type_ids if shared else None)
+        tag_observations = lexicon_vocab.map_typeids_to_tag_observations(type_ids) if force else None
+        return self.crf.viterbi_tags(lstm_out, word_mask, self.crf_engine, tag_observations)
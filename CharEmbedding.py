@@ -1,10 +1,12 @@
+import hashlib
+import json
+import os
 import numpy as np
 import torch
 from torch._C import dtype
 import torch.nn as nn
-from gensim.models import Word2Vec
 from AttentionPooling import AttentionPooling
-from Utils import logger
+from Utils import logger, model_key
 
 
 class CharEmbedding(nn.Module):
@@ -19,8 +21,7 @@ class CharEmbedding(nn.Module):
 
         if use_pretrained_char:
             self.freeze = not fine_tune
-            self.embeddings = self.init_char_embedding(path, char_to_ix)
-            self.embeddings = torch.tensor(self.embeddings, dtype = torch.float)
+            self.embeddings = torch.from_numpy(self.init_char_embedding(path, char_to_ix))
             self.char_embeds = nn.Embedding.from_pretrained(self.embeddings, freeze = self.freeze) # fine-tune
             self.char_emb_dim = self.embeddings.shape[1]
             logger('pretrained char path: {}'.format(path))
@@ -36,17 +37,31 @@ class CharEmbedding(nn.Module):
                 self.atten_pool = AttentionPooling(char_emb_dim, char_emb_dim)
 
     def init_char_embedding(self, path, vocab_to_ix):
-        word2index = Word2Vec.load(path) # Word2Vec(vocab=20022, vector_size=200, alpha=0.025)
-        matrix=np.random.normal(size=(len(vocab_to_ix)+1,200))
-        #pretrained = 0
+        '''
+        the resolved matrix is cached in {path}.{model key}_{vocab key}.npy, a cache hit memory-maps it without loading gensim
+        output:
+            matrix: (len(vocab_to_ix) + 1, 200) float32, copy-on-write memory map
+        '''
+        vocab_key = hashlib.sha1(json.dumps(vocab_to_ix, sort_keys = True).encode('utf-8')).hexdigest()[: 16]
+        cache_path = '{}.{}_{}.npy'.format(path, model_key(path), vocab_key)
+        if not os.path.exists(cache_path):
+            from gensim.models import Word2Vec
+            word2index = Word2Vec.load(path) # Word2Vec(vocab=20022, vector_size=200, alpha=0.025)
+            matrix=np.random.normal(size=(len(vocab_to_ix)+1,200))
+            #pretrained = 0
 
-        for word in vocab_to_ix.keys():
-            index=vocab_to_ix[word]
-            if word in word2index.wv:
-                matrix[index,:]=word2index.wv[word]
-                #pretrained += 1
-        #print(pretrained)
-        return matrix
+            for word in vocab_to_ix.keys():
+                index=vocab_to_ix[word]
+                if word in word2index.wv:
+                    matrix[index,:]=word2index.wv[word]
+                    #pretrained += 1
+            #print(pretrained)
+            temp_path = '{}.{}.npy'.format(cache_path, os.getpid())
+            np.save(temp_path, matrix.astype(np.float32))
+            os.replace(temp_path, cache_path) # other processes never see a partial file
+            logger('Save pretrained char embedding cache {}'.format(cache_path))
+        # copy-on-write, fine-tuning writes private pages and never the cache file
+        return np.load(cache_path, mmap_mode = 'c')
 
     def get_emb_dim(self):
         return self.char_emb_dim
@@ -75,21 +90,48 @@ class CharEmbedding(nn.Module):
             char_ids = torch.unsqueeze(char_ids, dim = 2) # (batch_size, max_sen_len, 1), max_word_len = 1
         
         batch_size, max_sen_len, max_word_len = char_ids.shape # (batch_size, max_sen_len, max_word_len)
+        word_chars = char_ids.reshape(batch_size * max_sen_len, max_word_len)
+        if self.training or torch.compiler.is_compiling():
+            # every word position draws its own dropout mask in training,
+            # and unique has data-dependent shapes, the compiled steps encode every word position
+            char_emb = self.encode_words(word_chars, max_word_len, dim)
+        else:
+            # each word type of the batch is encoded once, trimmed to the longest word of the batch, exact without dropout
+            width = max_word_len
+            if self.use_cnn and dim == 3:
+                width = min(max_word_len, torch.max(torch.sum(word_chars != 0, dim = 1)).item() + 3)
+            unique_words, inverse = torch.unique(word_chars[:, : width], dim = 0, return_inverse = True)
+            char_emb = self.encode_words(unique_words, max_word_len, dim)[inverse]
+        return char_emb.reshape(batch_size, max_sen_len, -1) # (batch_size, max_sen_len, embed_size)
+
+    def encode_words(self, word_chars, max_word_len, dim):
+        '''
+        input:
+            word_chars: (num_words, width), chars of words padded to max_word_len and trimmed to width,
+                        width >= longest word + 3 if width < max_word_len
+        output:
+            char_embeds: (num_words, embed_size)
+        '''
+        num_words, width = word_chars.shape
         emb_size = self.char_emb_dim
-        char_emb = self.char_embeds(char_ids) # (batch_size, max_sen_len, max_word_len, embed_size)
+        char_emb = self.char_embeds(word_chars) # (num_words, width, embed_size)
         if self.use_cnn:
-            char_emb = char_emb.reshape(batch_size * max_sen_len, max_word_len, emb_size)
-            char_emb = char_emb.permute(0, 2, 1) # (batch_size * max_sen_len, embed_size, max_word_len)
+            char_emb = char_emb.permute(0, 2, 1) # (num_words, embed_size, width)
             char_emb = self.dropout(char_emb)
-            char_emb = self.cnn(char_emb) # (batch_size * max_sen_len, embed_size, max_word_len)
-            char_emb = char_emb.reshape(batch_size, max_sen_len, -1, emb_size) # (batch_size, max_sen_len, max_word_len, embed_size)
+            char_emb = self.cnn(char_emb) # (num_words, embed_size, width)
+            if width < max_word_len:
+                # the trimmed columns only see padding chars, as column width - 2 does,
+                # the last column also sees the zero padding of the conv, as column max_word_len - 1 does
+                padding = char_emb[:, :, width - 2: width - 1].expand(-1, -1, max_word_len - width)
+                char_emb = torch.cat((char_emb[:, :, : width - 1], padding, char_emb[:, :, width - 1:]), dim = 2)
+            char_emb = char_emb.reshape(num_words, -1, emb_size) # (num_words, max_word_len, embed_size)
         
         if dim == 2: # 二维情况下不用 pooling
-            char_emb = torch.squeeze(char_emb, dim = 2) # (batch_size, max_sen_len, embed_size)
+            char_emb = torch.squeeze(char_emb, dim = 1) # (num_words, embed_size)
         elif self.attention_pooling:
-            char_emb = self.atten_pool(char_emb)
+            char_emb = self.atten_pool(char_emb.unsqueeze(0)).squeeze(0)
         else:
-            char_emb = torch.max(char_emb, dim = 2).values # (batch_size, max_sen_len, embed_size)
+            char_emb = torch.max(char_emb, dim = 1).values # (num_words, embed_size)
         return char_emb
     
     def __len__(self):
@@ -1,6 +1,10 @@
 import copy
+import os
+import time
+import numpy as np
 import torch
 from torch.utils.data import Dataset
+from Utils import logger
 
 def bio1_bioes(tags):
     # [tag1, tag2, ..., tag n]
@@ -24,11 +28,43 @@ def bio1_bioes(tags):
     return new_tags
     
 
+def convert_pretrained(prefix, num_words, lines):
+    '''
+    one-time conversion of text pretrained embeddings to {prefix}.vocab and {prefix}.npy
+    lines: num_words (word, 'emb1 emb2 ... emb n')
+    {prefix}.vocab: one word per line
+    {prefix}.npy: (num_words + 2, emb_len) float32, rows 0 and 1 are zeros for <PAD> and <OOV>, row i + 2 is word i
+    '''
+    start = time.time()
+    matrix = None
+    temp_path = '{}.{}.npy'.format(prefix, os.getpid())
+    with open('{}.{}.vocab'.format(prefix, os.getpid()), 'w', encoding = 'utf-8') as vocab:
+        for i, (word, embeds) in enumerate(lines):
+            embeds = np.array(embeds.split(), dtype = np.float32)
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.float32, shape = (num_words + 2, embeds.shape[0]))
+                matrix[: 2] = 0
+            matrix[i + 2] = embeds
+            vocab.write(word + '\n')
+    matrix.flush()
+    del matrix
+    # other processes never see a partial file, the vocab is replaced first as load_glove and load_senna check the matrix
+    os.replace('{}.{}.vocab'.format(prefix, os.getpid()), prefix + '.vocab')
+    os.replace(temp_path, prefix + '.npy')
+    logger('Convert pretrained word embedding to {}.npy, {} words, {:.1f}s'.format(prefix, num_words, time.time() - start))
+
 # load pretrains
 class WordVocab():
-    def __init__(self, dataset_path = None):
+    def __init__(self, dataset_path = None, out_of_core = False):
+        '''
+        out_of_core: keep the whole pretrained vocabulary, word ids are the rows of the pretrained table word_emb_path,
+                     which is memory-mapped by WordEmbedding instead of loaded as word_emb,
+                     dataset words without pretrained embedding are <OOV>
+        '''
         self.OOV_TAG = '<OOV>'
         self.PAD_TAG = '<PAD>'
+        self.out_of_core = out_of_core
+        self.word_emb_path = None
         if dataset_path is None:
             dataset_path = '/data/CoNLL2003/'
         pretrained_path = '/data/Glove/glove.6B.100d.txt'
@@ -60,44 +96,51 @@ class WordVocab():
         f.close()
         
     def load_glove(self, path):
-        word_to_ix = {self.PAD_TAG: 0, self.OOV_TAG: 1}
-        word_emb = []
-        with open(path, 'r') as glove:
-            for line in glove.readlines():
-                data = line.strip().split(' ') # [word emb1 emb2 ... emb n]
-                word = data[0]
-                embeds = [float(i) for i in data[1:]]
-                word_to_ix[word] = len(word_to_ix)
-                word_emb.append(embeds)
-        
-        word_emb.insert(0, [0.] * len(word_emb[0]))
-        word_emb.insert(0, [0.] * len(word_emb[0]))
-        
-        used_idx = [word_to_ix[word] if word in word_to_ix else word_to_ix[self.OOV_TAG] for word in self.word_list]
-        self.word_emb = torch.tensor(word_emb, dtype = torch.float)[used_idx]
+        prefix = os.path.splitext(path)[0]
+        if not os.path.exists(prefix + '.npy'):
+            with open(path, 'r') as glove:
+                num_words = sum(1 for line in glove)
+            with open(path, 'r') as glove:
+                lines = (line.rstrip('\n').split(' ', 1) for line in glove) # [word, 'emb1 emb2 ... emb n']
+                convert_pretrained(prefix, num_words, lines)
+        self.word_emb = self.load_pretrained(prefix)
         return self.word_emb
         
     def load_senna(self, path):
         path = '/data/Senna/'
+        prefix = path + 'embeddings'
+        if not os.path.exists(prefix + '.npy'):
+            with open(path + 'word_list.txt', 'r') as f:
+                words = [line.strip() for line in f]
+            with open(path + 'embeddings.txt', 'r') as f:
+                lines = ((word, line) for word, line in zip(words, f))
+                convert_pretrained(prefix, len(words), lines)
+        self.word_emb = self.load_pretrained(prefix)
+        return self.word_emb
+
+    def load_pretrained(self, prefix):
+        '''
+        rows of the binary pretrained embeddings of convert_pretrained for word_list, memory-mapped, only these rows are read
+        out_of_core: the vocabulary becomes the pretrained vocabulary and no rows are read
+        output:
+            word_emb: (len(word_list), emb_len), zeros for <PAD> and <OOV>, None if out_of_core
+        '''
         word_to_ix = {self.PAD_TAG: 0, self.OOV_TAG: 1}
-        word_emb = []
-        with open(path + 'word_list.txt', 'r') as f:
-            for line in f.readlines():
-                word = line.strip()
-                word_to_ix[word] = len(word_to_ix)
-        with open(path + 'embeddings.txt', 'r') as f:
-            for line in f.readlines():
-                embeds = line.strip().split(' ')
-                embeds = [float(i) for i in embeds]
-                word_to_ix[word] = len(word_to_ix)
-                word_emb.append(embeds)
-        
-        word_emb.insert(0, [0.] * len(word_emb[0]))
-        word_emb.insert(0, [0.] * len(word_emb[0]))
-        
+        with open(prefix + '.vocab', 'r', encoding = 'utf-8') as f:
+            for i, line in enumerate(f):
+                word_to_ix[line.rstrip('\n')] = i + 2
+        matrix = np.load(prefix + '.npy', mmap_mode = 'r')
+        if self.out_of_core:
+            self.word_to_ix = word_to_ix
+            self.word_list = [self.PAD_TAG, self.OOV_TAG] + [None] * (matrix.shape[0] - 2)
+            for word, ix in word_to_ix.items():
+                self.word_list[ix] = word
+            self.word_emb_path = prefix + '.npy'
+            logger('Use out-of-core pretrained word embedding {}. Shape: {}'.format(self.word_emb_path, matrix.shape))
+            return None
         used_idx = [word_to_ix[word] if word in word_to_ix else word_to_ix[self.OOV_TAG] for word in self.word_list]
-        self.word_emb = torch.tensor(word_emb, dtype = torch.float)[used_idx]
-        return self.word_emb
+        logger('Load pretrained word embedding {}.npy. Shape: {}, used: {}'.format(prefix, matrix.shape, len(used_idx)))
+        return torch.from_numpy(matrix[used_idx])
     
     def map_word(self, words, dim = 2):
         if dim == 2: # words
@@ -133,6 +176,21 @@ class WordVocab():
 #         if dim == 1:
 #             return self.tag_to_ix[tags]
 
+
+def padding_chars(sentence, max_word_len = 16, padding_value = 0):
+    '''
+    pad and truncate the chars of every word to max_word_len, the char width of ConllDataset
+    input:
+        sentence:       list(list), char ids of each word
+    output:
+        padded_data:    (sen_len, max_word_len)
+        padded_mask:    (sen_len, max_word_len)
+    '''
+    padded_data = [word[: max_word_len] + [padding_value] * (max_word_len - len(word)) for word in sentence]
+    padded_mask = [[1] * len(word[: max_word_len]) + [0] * (max_word_len - len(word)) for word in sentence]
+    return padded_data, padded_mask
+
+
 class ConllDataset(Dataset):
     def __init__(self, path, word_vocab = None, tag_vocab = None):
         super().__init__()
@@ -207,8 +265,9 @@ class ConllDataset(Dataset):
         if dim == 3: # char padding, [[char1, char2, ..], [], ...]
             zero_padding = [padding_value] * max_word_len # [0, 0, 0, ..]
             zero_mask = [0] * max_word_len
-            padded_data = [word[: max_word_len] + [padding_value] * (max_word_len - len(word)) for word in sentence] + [zero_padding] * (max_sen_len - len(sentence))
-            padded_mask = [[1] * len(word[: max_word_len]) + [0] * (max_word_len - len(word)) for word in sentence] + [zero_mask] * (max_sen_len - len(sentence))
+            padded_data, padded_mask = padding_chars(sentence, max_word_len, padding_value)
+            padded_data = padded_data + [zero_padding] * (max_sen_len - len(sentence))
+            padded_mask = padded_mask + [zero_mask] * (max_sen_len - len(sentence))
             return padded_data[: max_sen_len], padded_mask[: max_sen_len]
 
     def __len__(self):
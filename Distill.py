@@ -0,0 +1,185 @@
+import json
+import os
+import re
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from Benchmark import throughput
+from BiLSTM_CRF import BiLSTM_CRF
+from CCKSData import CCKSDataset
+from pytorchtools import EarlyStopping
+from Utils import logger
+
+def load_unlabeled(path, vocab, tag_vocab):
+    '''
+    unlabeled CCKS text, one document per line, plain text or json with 'originalText'
+    documents are split into sentences as CCKSDataset.load_ccks does, tags are all 'O' and not used
+    '''
+    dataset = CCKSDataset(None, vocab, tag_vocab, mod = 'unlabeled')
+    length = dataset.max_sen_len - 1
+    with open(path, 'r', encoding = 'utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            text = json.loads(line)['originalText'] if line.startswith('{') else line
+            for sen in re.split('[。；？！;?!]', text):
+                for begin in range(0, len(sen), length):
+                    dataset.label_data(sen[begin: begin + length] + '。', [])
+    dataset.char_ids = torch.tensor(dataset.char_ids, dtype = torch.long)
+    dataset.char_masks = torch.tensor(dataset.char_masks, dtype = torch.bool)
+    dataset.tag_ids = torch.tensor(dataset.tag_ids, dtype = torch.long)
+    logger('Load unlabeled data. Sentences: {}'.format(len(dataset)))
+    return dataset
+
+
+class Distiller():
+    def __init__(self, trainer, mode = 'crf', temperature = 1.0, alpha = 0.5,
+            char_emb_dim = 128, hidden_dim = 256, epochs = 30, lr = 1e-3
+            ):
+        '''
+        train a small char-only student from the model of a Train_Chinese.Trainer, e.g. with use_lm and use_lexicon
+        mode:
+            'crf': match the teacher CRF distribution, unary and pairwise marginals are the soft targets
+            'emission': match the softmax of the teacher emissions, softened by temperature
+        alpha: weight of the gold label loss on labeled data, unlabeled data are trained on teacher targets only
+        '''
+        if mode not in ('crf', 'emission'):
+            raise ValueError('Unknown distillation mode: {}'.format(mode))
+        if mode == 'crf' and not trainer.use_crf:
+            raise ValueError("mode = 'crf' needs a teacher with use_crf.")
+        self.trainer = trainer
+        self.teacher = trainer.model
+        self.mode = mode
+        self.temperature = temperature
+        self.alpha = alpha
+        self.epochs = epochs
+        self.lr = lr
+        self.batch_size = trainer.batch_size
+        self.device = trainer.device
+        self.student = BiLSTM_CRF(
+            trainer.vocab, trainer.tag_vocab,
+            char_emb_dim, 0, 0, 0, 0, hidden_dim, 1,
+            self.batch_size, self.device, trainer.dropout,
+            use_word = False, use_char = True, use_lm = False, use_crf = trainer.use_crf, use_cnn = True, use_lexicon = False,
+            use_pretrained_word = False, use_pretrained_char = False
+        ).to(self.device)
+        logger('Distillation mode = {}, temperature = {}, alpha = {}'.format(mode, temperature, alpha))
+
+    def batches(self, dataset):
+        i = 0
+        while i < len(dataset):
+            batch = dataset[i: i + self.batch_size]
+            i += self.batch_size
+            text, char_ids, char_mask, tag_ids = batch
+            sen_len = max([len(sentence) for sentence in text])
+            yield text, char_ids[:, : sen_len].to(self.device), char_mask[:, : sen_len].to(self.device), tag_ids[:, : sen_len].to(self.device)
+
+    def teacher_emissions(self, dataset):
+        '''
+        the teacher (ELMo, lexicon) runs once per sentence, its emissions are kept on CPU for all epochs
+        '''
+        self.teacher.eval()
+        emissions = []
+        with torch.no_grad():
+            for text, char_ids, char_mask, _ in self.batches(dataset):
+                emission, _ = self.teacher._get_emissions(text, None, None, char_ids, char_mask)
+                emissions.append(emission.cpu())
+        return emissions
+
+    def loss(self, batch, teacher_emission, labeled = True):
+        text, char_ids, char_mask, tag_ids = batch
+        batch_size = char_ids.shape[0]
+        teacher_emission = teacher_emission.to(self.device)
+        emission, mask = self.student._get_emissions(text, None, None, char_ids, char_mask)
+        if self.mode == 'crf':
+            marginals, pair_marginals = self.teacher.crf.marginals(teacher_emission, mask, pairwise = True)
+            loss = -self.student.crf.soft_likelihood(emission, mask, marginals, pair_marginals, self.student.crf_engine) / batch_size
+        else:
+            target = F.softmax(teacher_emission / self.temperature, dim = 2)
+            log_prob = F.log_softmax(emission / self.temperature, dim = 2)
+            kl = F.kl_div(log_prob, target, reduction = 'none').sum(2)
+            loss = torch.sum(kl * mask.float()) / batch_size * self.temperature ** 2
+        if labeled and self.alpha > 0:
+            if self.student.use_crf:
+                gold_loss = -self.student.crf(emission, tag_ids, mask, self.student.crf_engine) / batch_size
+            else:
+                gold_loss = F.cross_entropy(emission.permute(0, 2, 1), tag_ids)
+            loss = self.alpha * gold_loss + (1 - self.alpha) * loss
+        return loss
+
+    def train(self, unlabeled_set = None):
+        student = self.student
+        optimizer = optim.Adam(student.parameters(), lr = self.lr)
+        early_stopping = EarlyStopping(patience = 10, verbose = False)
+        train_sets = [(self.trainer.train_set, True)]
+        if unlabeled_set is not None:
+            train_sets.append((unlabeled_set, False))
+        logger('Compute teacher emissions.')
+        targets = [self.teacher_emissions(dataset) for dataset, _ in train_sets]
+        valid_targets = self.teacher_emissions(self.trainer.valid_set)
+
+        for epoch in range(self.epochs):
+            train_losses = []
+            valid_losses = []
+            student.train()
+            for (dataset, labeled), emissions in zip(train_sets, targets):
+                for batch, teacher_emission in zip(self.batches(dataset), emissions):
+                    optimizer.zero_grad()
+                    loss = self.loss(batch, teacher_emission, labeled)
+                    train_losses.append(loss.item())
+                    loss.backward()
+                    optimizer.step()
+
+            student.eval()
+            with torch.no_grad():
+                for batch, teacher_emission in zip(self.batches(self.trainer.valid_set), valid_targets):
+                    valid_losses.append(self.loss(batch, teacher_emission).item())
+            avg_train_loss = np.average(train_losses)
+            avg_valid_loss = np.average(valid_losses)
+            logger('[epoch {:3d}] train_loss: {:.8f}  valid_loss: {:.8f}'.format(epoch + 1, avg_train_loss, avg_valid_loss))
+            early_stopping(avg_valid_loss, student)
+            if early_stopping.early_stop:
+                logger("Early stopping")
+                break
+        # the student of the best validation loss, not of the last epoch
+        student.load_state_dict(torch.load(early_stopping.path))
+        logger('Load best student, valid_loss: {:.8f}'.format(early_stopping.val_loss_min))
+
+        model_time = '{}'.format(time.strftime('%m%d%H%M', time.localtime()))
+        model_path = './results/{}'.format(model_time)
+        os.makedirs(model_path, exist_ok = True) # may be the folder of the teacher
+        torch.save(student.state_dict(), model_path + '/student_' + model_time)
+        logger('Save student {}'.format(model_time))
+        return student
+
+    def evaluate(self):
+        '''
+        Trainer.test metrics and throughput of the teacher and the student
+        '''
+        results = {}
+        for name, model in [('teacher', self.teacher), ('student', self.student)]:
+            self.trainer.model = model
+            metrics = self.trainer.test()
+            metrics['throughput'] = throughput(self.trainer)
+            results[name] = metrics
+        self.trainer.model = self.teacher
+        for name, metrics in results.items():
+            logger('[Distill] {}: F1: {:.8f}, relaxed F1: {:.8f}, throughput: {:.1f} tokens/s'.format(
+                name, metrics['f1'], metrics['relax_f1'], metrics['throughput']))
+        return results
+
+if __name__ == '__main__':
+    from Train_Chinese import Trainer
+    data_path = '/data/CCKS2019/'
+    # teacher: trained with ELMo and lexicon
+    trainer = Trainer('train', None, data_path, epochs = 100,
+        use_word = False, use_char = True, use_lm = True, use_crf = True, use_lexicon = True,
+        use_pretrained_word = False, use_pretrained_char = False,
+        attention_pooling = False)
+    distiller = Distiller(trainer, mode = 'crf')
+    distiller.train()
+    distiller.evaluate()
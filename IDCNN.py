@@ -0,0 +1,54 @@
+import torch
+import torch.nn as nn
+
+class IDCNN(nn.Module):
+    def __init__(self, vocab, tag_vocab,
+            emb_dim, hidden_dim, num_layers, dropout = 0.5,
+            dilations = (1, 2, 4), kernel_size = 3
+            ):
+        '''
+        iterated dilated CNN encoder (Strubell et al., 2017), every position is computed in parallel
+        a block of dilated convolutions is applied 2 * num_layers times with shared parameters,
+        it has hidden_dim // 2 filters (the width of one lstm direction), the receptive field is 31 tokens when num_layers = 1
+        '''
+        super().__init__()
+        self.vocab = vocab
+        self.tag_vocab = tag_vocab
+
+        self.emb_dim = emb_dim
+        self.hidden_dim = hidden_dim
+        self.num_filters = hidden_dim // 2
+        self.num_blocks = max(num_layers, 1) * 2
+        self.tagset_size = len(tag_vocab.tag_to_ix)
+
+        self.dropout1 = nn.Dropout(p = dropout)
+        self.dropout2 = nn.Dropout(p = dropout)
+        self.input_conv = nn.Conv1d(emb_dim, self.num_filters, kernel_size, padding = kernel_size // 2)
+        self.block = nn.ModuleList([
+            nn.Conv1d(self.num_filters, self.num_filters, kernel_size, padding = dilation * (kernel_size // 2), dilation = dilation)
+            for dilation in dilations
+        ])
+        self.activation = nn.ReLU()
+        self.hidden2tag = nn.Linear(self.num_filters, self.tagset_size)
+
+    def forward(self, embeds, word_mask, label = None): # (batch_size, sen_len)
+        '''
+        input:
+            embeds:     (batch_size, sen_len, emb_size)
+            word_mask:  (batch_size, sen_len)
+            label:      (batch_size, sen_len)
+        output:
+            cnn_feats: (batch_size, sen_len, tagset_size)
+        '''
+        # padded positions are kept zero so that they never leak into real tokens
+        mask = word_mask.unsqueeze(1).to(embeds.dtype) # (batch_size, 1, sen_len)
+        embeds = self.dropout1(embeds)
+        hidden = self.activation(self.input_conv(embeds.transpose(1, 2) * mask)) * mask # (batch_size, num_filters, sen_len)
+        for _ in range(self.num_blocks):
+            for conv in self.block:
+                hidden = self.activation(conv(hidden)) * mask
+            hidden = self.dropout1(hidden)
+        cnn_feats = self.hidden2tag(hidden.transpose(1, 2)) # (batch_size, sen_len, tagset_size)
+        cnn_feats = self.dropout2(cnn_feats)
+
+        return cnn_feats
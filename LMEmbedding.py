@@ -1,7 +1,15 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+import numpy as np
 import torch
 import torch.nn as nn
-from allennlp.modules.elmo import Elmo, batch_to_ids
-from Utils import logger
+from allennlp.modules.elmo import _ElmoBiLm, batch_to_ids
+from allennlp.modules.scalar_mix import ScalarMix
+from allennlp.nn.util import remove_sentence_boundaries
+from Utils import logger, model_key
 
 '''
 allennlp/allennlp/modules/token_embedders/elmo_token_embedder.py 
@@ -13,8 +21,154 @@ class ElmoTokenEmbedder(TokenEmbedder):
 
 batch_to_ids: torch: (len(batch), max sentence length, max word length)
 '''
+class ELMoCache():
+    '''
+    biLM layer activations of sentences on disk, before the trainable scalar mix and dropout of Elmo
+    {cache_dir}/{model_key}/activations.f16: (num_tokens, num_layers, dim) float16, memory-mapped, append-only
+    {cache_dir}/{model_key}/index.txt: lines of 'sentence_key offset length', written after the activations
+    processes may share a cache, put appends under an exclusive flock of the activations file
+    '''
+    def __init__(self, cache_dir, model_key, num_layers, dim):
+        path = os.path.join(cache_dir, model_key)
+        os.makedirs(path, exist_ok = True)
+        self.data_path = os.path.join(path, 'activations.f16')
+        self.index_path = os.path.join(path, 'index.txt')
+        self.num_layers = num_layers
+        self.dim = dim
+        self.row_bytes = num_layers * dim * 2
+        # a partly written row of an interrupted run is skipped by the next put, the file is never truncated
+        self.num_tokens = os.path.getsize(self.data_path) // self.row_bytes if os.path.exists(self.data_path) else 0
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 3 or not line.endswith('\n'): # partly written line
+                        continue
+                    key, offset, length = fields[0], int(fields[1]), int(fields[2])
+                    if offset + length <= self.num_tokens:
+                        self.index[key] = (offset, length)
+        self.data = None # np.memmap, reopened when the file grows
+        logger('Load ELMo cache {}. Sentences: {}, tokens: {}'.format(path, len(self.index), self.num_tokens))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None # copies of the model map the file again
+        return state
+
+    def __contains__(self, key):
+        return key in self.index
+
+    @staticmethod
+    def key(sentence):
+        return hashlib.sha1('\x1f'.join(sentence).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        output:
+            activations: (length, num_layers, dim) float16, a view of the memory-mapped file
+        '''
+        offset, length = self.index[key]
+        if self.data is None or self.data.shape[0] < offset + length:
+            # copy-on-write mapping of the whole rows written so far, the file is never modified through it
+            num_tokens = os.path.getsize(self.data_path) // self.row_bytes
+            self.data = np.memmap(self.data_path, dtype = np.float16, mode = 'c', shape = (num_tokens, self.num_layers, self.dim))
+        return torch.from_numpy(self.data[offset: offset + length])
+
+    def put(self, keys, activations):
+        '''
+        keys: list of sentence keys
+        activations: list of (length, num_layers, dim)
+        '''
+        rows = [activation.detach().to('cpu', torch.float16).numpy().tobytes() for activation in activations]
+        lines = []
+        with open(self.data_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # the end of the file under the lock, other processes may have appended since this one last wrote
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+                if end % self.row_bytes: # skip a partly written row of an interrupted run
+                    f.write(b'\0' * (self.row_bytes - end % self.row_bytes))
+                    end = f.tell()
+                offset = end // self.row_bytes
+                for key, activation, row in zip(keys, activations, rows):
+                    f.write(row)
+                    self.index[key] = (offset, activation.shape[0])
+                    lines.append('{} {} {}\n'.format(key, offset, activation.shape[0]))
+                    offset += activation.shape[0]
+                f.flush()
+                # index lines only point to flushed activations
+                with open(self.index_path, 'ab+') as index_file:
+                    if index_file.seek(0, os.SEEK_END) > 0:
+                        index_file.seek(-1, os.SEEK_END)
+                        if index_file.read(1) != b'\n': # end a partly written line of an interrupted run
+                            index_file.write(b'\n')
+                    index_file.write(''.join(lines).encode('utf-8'))
+                self.num_tokens = offset
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+bilms = {} # (options_file, weight_file, device, shared_dir) -> frozen biLM, shared by the LMEmbedding of a process
+
+def load_bilm(options_file, weight_file, device, shared_dir = None):
+    '''
+    the frozen ELMo biLM, loaded once per process
+    shared_dir: the biLM is saved once to shared_dir as a torch file and memory-mapped from there,
+                so processes on one host share one copy of the weights in the page cache (CPU only, cuda copies it)
+    '''
+    key = (options_file, weight_file, device, shared_dir)
+    if key not in bilms:
+        start = time.time()
+        if shared_dir is None:
+            bilm = _ElmoBiLm(options_file, weight_file, requires_grad = False)
+        else:
+            path = os.path.join(shared_dir, 'elmo_bilm_{}.pt'.format(model_key(options_file, weight_file)))
+            if not os.path.exists(path):
+                os.makedirs(shared_dir, exist_ok = True)
+                temp_path = '{}.{}'.format(path, os.getpid())
+                torch.save(_ElmoBiLm(options_file, weight_file, requires_grad = False), temp_path)
+                os.replace(temp_path, path) # other processes never see a partial file
+            bilm = torch.load(path, mmap = True, weights_only = False)
+        bilms[key] = bilm.to(device).eval()
+        logger('Load ELMo biLM {}. shared = {}, {:.1f}s'.format(weight_file, shared_dir is not None, time.time() - start))
+    return bilms[key]
+
+
+class ElmoMix(nn.Module):
+    '''
+    the trainable part of allennlp Elmo, the scalar mix of the biLM layers and dropout
+    keeps the state dict keys of Elmo, the frozen biLM weights (_elmo_lstm) are not part of the state dict
+    '''
+    def __init__(self, num_layers, dropout = 0.1):
+        super().__init__()
+        self.scalar_mix_0 = ScalarMix(num_layers, do_layer_norm = False)
+        self._dropout = nn.Dropout(p = dropout)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # models saved with the whole Elmo carry the biLM weights, which are the ones of weight_file
+        for key in [key for key in state_dict if key.startswith(prefix + '_elmo_lstm.')]:
+            del state_dict[key]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, layers):
+        '''
+        input:
+            layers: list of num_layers (batch_size, max_sen_len, dim), without sentence boundaries
+        output:
+            lm_emb: [(batch_size, max_sen_len, dim)]
+        '''
+        return [self._dropout(self.scalar_mix_0(layers))]
+
+
 class LMEmbedding(nn.Module):
-    def __init__(self, lm_emb_dim, num_output_representations = 1, requires_grad = False, dropout = 0.1):
+    def __init__(self, lm_emb_dim, num_output_representations = 1, requires_grad = False, dropout = 0.1, cache_dir = None, shared_dir = None):
+        '''
+        the biLM is loaded on the first forward, only the options are read here, see load_bilm
+        cache_dir: keep the biLM activations of every sentence in an ELMoCache under cache_dir, the biLM runs once per sentence
+        shared_dir: memory-map the biLM weights from shared_dir, see load_bilm
+        '''
         super().__init__()
         path = '/data/ELMo/'
         self.num_output_representations = num_output_representations
@@ -22,26 +176,44 @@ class LMEmbedding(nn.Module):
 
         self.fine_tune = False
 
-        self.lm_embeds = Elmo(
-            options_file = path + 'elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json', 
-            weight_file = path + 'elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5', 
-            num_output_representations = 1,
-            requires_grad = self.fine_tune,
-            dropout = dropout
-        )
+        self.options_file = path + 'elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json'
+        self.weight_file = path + 'elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5'
+        self.shared_dir = shared_dir
+        with open(self.options_file, 'r') as f:
+            options = json.load(f)
+        num_layers = options['lstm']['n_layers'] + 1 # token layer and lstm layers
+        output_dim = 2 * options['lstm']['projection_dim']
+        self.lm_embeds = ElmoMix(num_layers, dropout)
         self.lm_dense = False
         if self.lm_dense:
             self.lm_emb_dim = lm_emb_dim
-            self.pretrained_dim = self.lm_embeds.get_output_dim()
+            self.pretrained_dim = output_dim
             self.lm_dense = nn.Linear(self.pretrained_dim, self.lm_emb_dim)
         else:
-            self.lm_emb_dim = self.lm_embeds.get_output_dim()
+            self.lm_emb_dim = output_dim
         
-        logger('Load Elmo. fine-tune = {}, Size = {}'.format(self.fine_tune, self.lm_emb_dim))
+        logger('Elmo. fine-tune = {}, Size = {}'.format(self.fine_tune, self.lm_emb_dim))
+
+        self.cache = None
+        if cache_dir is not None and not self.fine_tune:
+            self.cache = ELMoCache(cache_dir, model_key(self.options_file, self.weight_file), num_layers, output_dim)
 
     def get_emb_dim(self):
         return self.lm_emb_dim
 
+    def bilm(self):
+        return load_bilm(self.options_file, self.weight_file, self.device, self.shared_dir)
+
+    def activations(self, text):
+        '''
+        output:
+            layers: list of num_layers (batch_size, max_sen_len, dim), without sentence boundaries
+        '''
+        char_ids = batch_to_ids(text).to(self.device)
+        with torch.no_grad():
+            bilm_output = self.bilm()(char_ids)
+        return [remove_sentence_boundaries(layer, bilm_output['mask'])[0] for layer in bilm_output['activations']]
+
     def forward(self, text):
         '''
         input:
@@ -50,14 +222,48 @@ class LMEmbedding(nn.Module):
         output:
             word_embeds: (batch_size, max_sen_len, emb_len)
         '''
-        char_ids = batch_to_ids(text).to(self.device)
-        lm_emb = self.lm_embeds(char_ids)['elmo_representations'] # List[torch.Tensor]
+        if self.cache is not None:
+            layers = self.cached_activations(text)
+        else:
+            layers = self.activations(text)
+        # the scalar mix has no layer norm, so sentence boundaries can be removed before mixing as well as after
+        lm_emb = self.lm_embeds(layers) # List[torch.Tensor]
         if self.num_output_representations == 1:
             lm_emb = lm_emb[0]
         if self.lm_dense:
             lm_emb = self.lm_dense(lm_emb)
         return lm_emb
 
+    def cached_activations(self, text):
+        '''
+        biLM activations of text, sentences missing in the cache are computed and added
+        output:
+            layers: list of num_layers (batch_size, max_sen_len, dim)
+        '''
+        keys = [ELMoCache.key(sentence) for sentence in text]
+        missing = {}
+        for key, sentence in zip(keys, text):
+            if key not in self.cache:
+                missing[key] = sentence
+        if missing:
+            activations = torch.stack(self.activations(list(missing.values())), dim = 2) # (num_missing, max_sen_len, num_layers, dim)
+            self.cache.put(list(missing.keys()), [activations[i, : len(sentence)] for i, sentence in enumerate(missing.values())])
+
+        sen_len = max([len(sentence) for sentence in text])
+        # each sentence is copied once, from the memory map into the float32 batch on device
+        batch = torch.zeros(len(text), sen_len, self.cache.num_layers, self.cache.dim, device = self.device)
+        for i, (key, sentence) in enumerate(zip(keys, text)):
+            batch[i, : len(sentence)].copy_(self.cache.get(key))
+        return list(batch.unbind(2))
+
+    def precompute(self, sentences, batch_size = 64):
+        '''
+        fill the cache for sentences, e.g. the text of a dataset, before training
+        '''
+        for i in range(0, len(sentences), batch_size):
+            self.cached_activations(sentences[i: i + batch_size])
+        logger('ELMo cache: {} sentences, {} tokens'.format(len(self.cache.index), self.cache.num_tokens))
+
 '''
 reference:
 https://github.com/allenai/allennlp/blob/main/allennlp/modules/elmo.py
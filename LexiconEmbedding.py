@@ -63,6 +63,47 @@ class LexiconVocab():
             self.expand_lexicon() # 16452 -> 85138
         self.word_list.sort(key = lambda x: len(x), reverse = True) # desceding order
         f.close()
+        self.build_index()
+
+    def build_index(self):
+        '''
+        character trie of the lexicon, built once instead of one text.find per word and sentence
+        output:
+            self.trie       {char: {char: ..., '': word}}, '' marks the end of a word
+            self.word_rank  {word: first position in self.word_list}
+        '''
+        self.trie = {}
+        for word in self.word_list:
+            node = self.trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = word
+        self.word_rank = {}
+        for i, word in enumerate(self.word_list):
+            # a word listed twice is matched at its first position, as the scan over self.word_list reaches it
+            self.word_rank.setdefault(word, i)
+
+    def find_words(self, text):
+        '''
+        all lexicon words in text, in the order of the scan over self.word_list: longer words first, then left to right
+        input:
+            text:       str
+        output:
+            matches:    list((word, start_pos))
+        '''
+        if getattr(self, 'trie', None) is None: # vocab pickled before the index was added
+            self.build_index()
+        matches = []
+        for start_pos in range(len(text)):
+            node = self.trie
+            for char in text[start_pos:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                if '' in node:
+                    matches.append((self.word_rank[node['']], start_pos))
+        matches.sort()
+        return [(self.word_list[rank], start_pos) for rank, start_pos in matches]
 
     def expand_lexicon(self): # 16452 -> 85138
         rules = self.rules
@@ -105,31 +146,53 @@ class LexiconVocab():
             rules = []
         type_ids = [0 for _ in range(sen_len)]
         marked = [False for _ in range(sen_len)]
-        for word in self.word_list:
-            base = 0
-            pos = text.find(word)
-            while pos != -1:
-                start_pos = base + pos
-                end_pos = start_pos + len(word)
-                if not marked[start_pos] and not marked[end_pos]:
-                    type_id = self.word_to_typeid[word]
-                    for rule in rules:
-                        type, gap, chars, new_type = rule
-                        if type != self.word_to_type[word]:
-                            continue
-                        for char in chars:
-                            char_pos = text[end_pos:].find(char)
-                            if char_pos != -1 and char_pos < gap:
-                                end_pos += char_pos + len(char)
-                                type_id = self.type_to_id[new_type]
-                                break
-                    for i in range(start_pos, end_pos):
-                        type_ids[i] = type_id
-                        marked[i] = True
-                base = end_pos
-                pos = text[base:].find(word)
+        word, base = None, 0
+        for match, start_pos in self.find_words(text):
+            if match != word:
+                word, base = match, 0
+            if start_pos < base: # overlaps the previous occurrence of the same word
+                continue
+            end_pos = start_pos + len(word)
+            if not marked[start_pos] and not (end_pos < sen_len and marked[end_pos]):
+                type_id = self.word_to_typeid[word]
+                for rule in rules:
+                    type, gap, chars, new_type = rule
+                    if type != self.word_to_type[word]:
+                        continue
+                    for char in chars:
+                        char_pos = text[end_pos:].find(char)
+                        if char_pos != -1 and char_pos < gap:
+                            end_pos += char_pos + len(char)
+                            type_id = self.type_to_id[new_type]
+                            break
+                for i in range(start_pos, end_pos):
+                    type_ids[i] = type_id
+                    marked[i] = True
+            base = end_pos
         return type_ids
         
+    def map_typeids_to_tag_observations(self, type_ids):
+        '''
+        turn lexicon hits into BIOES tags for CRF.viterbi_tags
+        input:
+            type_ids:   (batch_size, max_sen_len), output of map_batch_to_typeid
+        output:
+            tag_observations: (batch_size, max_sen_len), tag id of each lexicon token, -1 elsewhere
+        '''
+        type_ids = torch.as_tensor(type_ids, dtype = torch.long)
+        # typeid_to_tagid: (type_size, 4), tag ids of B, I, E, S of each type
+        typeid_to_tagid = [[-1] * 4] + [[self.tag_to_ix[pos + '-' + type] for pos in ['B', 'I', 'E', 'S']] for type in self.type_list]
+        typeid_to_tagid = torch.tensor(typeid_to_tagid, dtype = torch.long, device = type_ids.device)
+        # consecutive tokens of the same type form one word, as in map_typeids_to_entity
+        padding = torch.zeros_like(type_ids[:, :1])
+        is_begin = type_ids != torch.cat([padding, type_ids[:, :-1]], dim = 1)
+        is_end = type_ids != torch.cat([type_ids[:, 1:], padding], dim = 1)
+        pos = torch.ones_like(type_ids) # I
+        pos[is_begin] = 0 # B
+        pos[is_end] = 2 # E
+        pos[is_begin & is_end] = 3 # S
+        return typeid_to_tagid[type_ids, pos]
+
     def map_typeids_to_entity(self, text, type_ids):
         '''
         input:
@@ -174,35 +237,35 @@ class LexiconVocab():
             rules = []
         marked = [False if t == self.tag_to_ix['O'] else True for t in range(tag_ids.shape[0])]
         
-        for word in self.word_list: # 遍历 lexicon
-            base = 0
-            pos = text.find(word) # 找句中有没有对应的 word
-            while pos != -1:
-                start_pos = base + pos
-                end_pos = start_pos + len(word)
-                if not marked[start_pos] and not marked[end_pos]: # 标记没有标出的词汇
-                    word_type = self.word_to_type[word] # 没有 rule 的时候用 word 原始的 type
-                    for rule in rules:
-                        type, gap, chars, new_type = rule
-                        if type != self.word_to_type[word]:
-                            continue
-                        for char in chars:
-                            char_pos = text[end_pos:].find(char)
-                            if char_pos != -1 and char_pos < gap:
-                                end_pos += char_pos + len(char)
-                                word_type = new_type # rule 匹配的时候用新的 type
+        word, base = None, 0
+        for match, start_pos in self.find_words(text): # 句中出现的 lexicon word
+            if match != word:
+                word, base = match, 0
+            if start_pos < base:
+                continue
+            end_pos = start_pos + len(word)
+            if not marked[start_pos] and not marked[end_pos]: # 标记没有标出的词汇
+                word_type = self.word_to_type[word] # 没有 rule 的时候用 word 原始的 type
+                for rule in rules:
+                    type, gap, chars, new_type = rule
+                    if type != self.word_to_type[word]:
+                        continue
+                    for char in chars:
+                        char_pos = text[end_pos:].find(char)
+                        if char_pos != -1 and char_pos < gap:
+                            end_pos += char_pos + len(char)
+                            word_type = new_type # rule 匹配的时候用新的 type
                     
-                    for i in range(start_pos, end_pos):
-                        marked[i] = True
-                    if end_pos - start_pos == 1:
-                        tag_ids[start_pos] = self.tag_to_ix['S-' + word_type]
-                    else:
-                        tag_ids[start_pos] = self.tag_to_ix['B-' + word_type]
-                        tag_ids[end_pos - 1] = self.tag_to_ix['E-' + word_type]
-                        for i in range(start_pos + 1, end_pos - 1):
-                            tag_ids[i] = self.tag_to_ix['I-' + word_type]
-                base = end_pos
-                pos = text[base:].find(word)
+                for i in range(start_pos, end_pos):
+                    marked[i] = True
+                if end_pos - start_pos == 1:
+                    tag_ids[start_pos] = self.tag_to_ix['S-' + word_type]
+                else:
+                    tag_ids[start_pos] = self.tag_to_ix['B-' + word_type]
+                    tag_ids[end_pos - 1] = self.tag_to_ix['E-' + word_type]
+                    for i in range(start_pos + 1, end_pos - 1):
+                        tag_ids[i] = self.tag_to_ix['I-' + word_type]
+            base = end_pos
         return tag_ids
 
 
@@ -229,15 +292,17 @@ class LexiconEmbedding(nn.Module):
         #logger('Load lexicon. Size = {}'.format(self.lexicon_size))
         #self.tag
 
-    def forward(self, text):
+    def forward(self, text, type_ids = None):
         '''
         input:
             text: list(list)
+            type_ids: (batch_size, sen_len), output of map_batch_to_typeid, computed from text if None
         output:
             lexicon_emb: (batch_size, sen_len, emb_size)
         '''
-        type_ids = self.lexicon_vocab.map_batch_to_typeid(text)
-        type_ids = torch.tensor(type_ids, dtype = torch.long).to(self.device)
+        if type_ids is None:
+            type_ids = self.lexicon_vocab.map_batch_to_typeid(text)
+        type_ids = torch.as_tensor(type_ids, dtype = torch.long).to(self.device)
         lexicon_emb = self.lexicon_embeds(type_ids)
         return lexicon_emb
     
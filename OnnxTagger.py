@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import onnxruntime
+import torch
+import torch.nn as nn
+
+from crf_numpy import NumpyCRFDecoder
+from TensorTagger import TensorTagger
+from Utils import logger
+
+def input_names(model):
+    '''
+    inputs of the exported emission stack, depending on the features of the model
+    '''
+    if model.use_word:
+        names = ['word_ids', 'word_mask'] + (['char_ids'] if model.use_char else [])
+    else:
+        names = ['char_ids', 'char_mask']
+    if model.use_lexicon:
+        names.append('lexicon_type_ids')
+    return names
+
+
+class EmissionStack(nn.Module):
+    '''
+    embedding, encoder and hidden2tag of a BiLSTM_CRF, (ids, masks) -> emissions
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.tagger = TensorTagger(model)
+        self.input_names = input_names(model)
+
+    def forward(self, *inputs):
+        feed = dict(zip(self.input_names, inputs))
+        emissions, _ = self.tagger.emissions(feed.get('word_ids'), feed.get('word_mask'),
+                                             feed.get('char_ids'), feed.get('char_mask'), feed.get('lexicon_type_ids'))
+        return emissions
+
+
+def export_onnx(model, path, opset_version = 17):
+    '''
+    write the emission stack of model to path (.onnx) with dynamic batch and sequence axes,
+    and the crf transitions next to it (path + '.crf.npz') if use_crf
+    '''
+    model.eval()
+    stack = EmissionStack(model).eval()
+    names = stack.input_names
+    # dummy inputs, the second sentence is padded so that the exported graph keeps the masking
+    mask = torch.tensor([[1, 1, 1, 1], [1, 1, 0, 0]], dtype = torch.bool, device = model.device)
+    ids = mask.long()
+    dummy = {
+        'word_ids': ids, 'word_mask': mask,
+        'char_ids': ids.unsqueeze(2).repeat(1, 1, 3) if model.use_word else ids, 'char_mask': mask,
+        'lexicon_type_ids': torch.zeros_like(ids),
+    }
+    dynamic_axes = {name: {0: 'batch_size', 1: 'sen_len'} for name in names}
+    if model.use_word and model.use_char:
+        dynamic_axes['char_ids'][2] = 'max_word_len'
+    dynamic_axes['emissions'] = {0: 'batch_size', 1: 'sen_len'}
+    with torch.no_grad():
+        torch.onnx.export(stack, tuple(dummy[name] for name in names), path,
+                          input_names = names, output_names = ['emissions'],
+                          dynamic_axes = dynamic_axes, opset_version = opset_version, dynamo = False)
+    if model.use_crf:
+        model.crf.export_decoder(path + '.crf.npz')
+    elif os.path.exists(path + '.crf.npz'): # left by a previous export, OnnxTagger would decode with it
+        os.remove(path + '.crf.npz')
+    logger('Export ONNX model to {}, inputs: {}'.format(path, names))
+
+
+class OnnxTagger():
+    def __init__(self, path, num_threads = 1):
+        '''
+        run a model written by export_onnx with onnxruntime on CPU
+        path: the .onnx file, the crf transitions are loaded from path + '.crf.npz' if it exists
+        '''
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers = ['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        try:
+            self.decoder = NumpyCRFDecoder.load(path + '.crf.npz')
+        except FileNotFoundError:
+            self.decoder = None
+
+    def emissions(self, **inputs):
+        '''
+        inputs: numpy arrays or tensors named as input_names
+        output:
+            emissions: (batch_size, sen_len, tagset_size)
+        '''
+        feed = {}
+        for name in self.input_names:
+            value = inputs[name]
+            if isinstance(value, torch.Tensor):
+                value = value.cpu().numpy()
+            feed[name] = value.astype(bool) if name.endswith('mask') else value.astype(np.int64)
+        return self.session.run(['emissions'], feed)[0]
+
+    def __call__(self, **inputs):
+        '''
+        output:
+            predict: (batch_size, sen_len), padded tokens are 0
+        '''
+        emissions = self.emissions(**inputs)
+        mask = inputs['word_mask'] if 'word_mask' in self.input_names else inputs['char_mask']
+        if isinstance(mask, torch.Tensor):
+            mask = mask.cpu().numpy()
+        mask = mask.astype(bool)
+        if self.decoder is None:
+            return emissions.argmax(2) * mask
+        return self.decoder.viterbi_tags(emissions, mask)
+
+
+def check_parity(model, onnx_tagger, text, **inputs):
+    '''
+    compare onnxruntime with the pytorch model on one batch
+    output:
+        max_diff: max absolute difference of the emissions on real tokens
+        agreement: fraction of real tokens with the same predicted tag
+    '''
+    model.eval()
+    with torch.no_grad():
+        emissions, mask = model._get_emissions(text, inputs.get('word_ids'), inputs.get('word_mask'),
+                                               inputs.get('char_ids'), inputs.get('char_mask'),
+                                               lexicon_type_ids = inputs.get('lexicon_type_ids'))
+        if model.use_crf:
+            predict = model.crf.viterbi_tags(emissions, mask)
+        else:
+            predict = emissions.argmax(2)
+    sen_len = emissions.shape[1]
+    mask = mask[:, : sen_len].bool().cpu().numpy()
+    onnx_emissions = onnx_tagger.emissions(**inputs)[:, : sen_len]
+    onnx_predict = onnx_tagger(**inputs)[:, : sen_len]
+    max_diff = float(np.abs(onnx_emissions - emissions.cpu().numpy())[mask].max())
+    agreement = float((onnx_predict == predict.cpu().numpy())[mask].mean())
+    logger('[ONNX] max emission diff: {:.6f}, tag agreement: {:.6f}'.format(max_diff, agreement))
+    return max_diff, agreement
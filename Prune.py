@@ -0,0 +1,194 @@
+import copy
+import os
+import time
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from Benchmark import latency, throughput
+from Utils import logger
+
+def unit_importance(lstm, hidden2tag):
+    '''
+    importance of the hidden units of each layer and direction of a bidirectional nn.LSTM,
+    the L2 norm of the weights reading the unit: the recurrent weights of all gates,
+    and the input weights of the next layer (both directions) or hidden2tag for the last layer
+    output:
+        importance: (num_layers, 2, hidden_size)
+    '''
+    hidden_size = lstm.hidden_size
+    importance = torch.zeros(lstm.num_layers, 2, hidden_size)
+    with torch.no_grad():
+        for layer in range(lstm.num_layers):
+            if layer + 1 < lstm.num_layers:
+                readers = [getattr(lstm, 'weight_ih_l{}{}'.format(layer + 1, suffix)) for suffix in ('', '_reverse')]
+            else:
+                readers = [hidden2tag.weight]
+            for direction, suffix in enumerate(('', '_reverse')):
+                square = getattr(lstm, 'weight_hh_l{}{}'.format(layer, suffix)).pow(2).sum(0) # (hidden_size)
+                for weight in readers:
+                    square = square + weight[:, direction * hidden_size: (direction + 1) * hidden_size].pow(2).sum(0)
+                importance[layer, direction] = square.sqrt().cpu()
+    return importance
+
+def prune_lstm(lstm, hidden2tag, keep):
+    '''
+    keep the keep most important hidden units of each layer and direction, remove the others structurally
+    output:
+        lstm:       nn.LSTM with hidden_size = keep
+        hidden2tag: nn.Linear with 2 * keep input features
+    '''
+    hidden_size = lstm.hidden_size
+    device = hidden2tag.weight.device
+    importance = unit_importance(lstm, hidden2tag)
+    index = importance.topk(keep, dim = 2).indices.sort(dim = 2).values.to(device) # (num_layers, 2, keep)
+
+    new_lstm = nn.LSTM(lstm.input_size, keep, num_layers = lstm.num_layers, bidirectional = True).to(device)
+    new_hidden2tag = nn.Linear(2 * keep, hidden2tag.out_features).to(device)
+    with torch.no_grad():
+        for layer in range(lstm.num_layers):
+            # the output of layer - 1 is [forward, backward]
+            input_index = torch.cat((index[layer - 1, 0], index[layer - 1, 1] + hidden_size)) if layer > 0 else None
+            for direction, suffix in enumerate(('', '_reverse')):
+                unit_index = index[layer, direction]
+                rows = torch.cat([unit_index + gate * hidden_size for gate in range(4)]) # gates i, f, g, o
+                weight_ih = getattr(lstm, 'weight_ih_l{}{}'.format(layer, suffix))[rows]
+                if input_index is not None:
+                    weight_ih = weight_ih[:, input_index]
+                getattr(new_lstm, 'weight_ih_l{}{}'.format(layer, suffix)).copy_(weight_ih)
+                getattr(new_lstm, 'weight_hh_l{}{}'.format(layer, suffix)).copy_(
+                    getattr(lstm, 'weight_hh_l{}{}'.format(layer, suffix))[rows][:, unit_index])
+                getattr(new_lstm, 'bias_ih_l{}{}'.format(layer, suffix)).copy_(getattr(lstm, 'bias_ih_l{}{}'.format(layer, suffix))[rows])
+                getattr(new_lstm, 'bias_hh_l{}{}'.format(layer, suffix)).copy_(getattr(lstm, 'bias_hh_l{}{}'.format(layer, suffix))[rows])
+        output_index = torch.cat((index[-1, 0], index[-1, 1] + hidden_size))
+        new_hidden2tag.weight.copy_(hidden2tag.weight[:, output_index])
+        new_hidden2tag.bias.copy_(hidden2tag.bias)
+    return new_lstm, new_hidden2tag
+
+def prune(model, ratio):
+    '''
+    remove ratio of the hidden units of the bilstm encoder of a trained BiLSTM_CRF
+    output:
+        pruned model with hidden_dim = 2 * keep, the input model is not modified,
+        its state dict loads into a BiLSTM_CRF built with the new hidden_dim
+    '''
+    if model.encoder != 'bilstm':
+        raise ValueError('Pruning supports the bilstm encoder only.')
+    hidden_size = model.bilstm.lstm.hidden_size
+    keep = max(1, int(round(hidden_size * (1 - ratio))))
+    model = copy.deepcopy(model)
+    model.bilstm.lstm, model.bilstm.hidden2tag = prune_lstm(model.bilstm.lstm, model.bilstm.hidden2tag, keep)
+    model.bilstm.hidden_dim = model.hidden_dim = 2 * keep
+    logger('Prune ratio = {}, hidden_dim: {} -> {}'.format(ratio, 2 * hidden_size, 2 * keep))
+    return model
+
+def batches(trainer, dataset):
+    '''
+    batches of a CoNLL or CCKS dataset as the arguments of BiLSTM_CRF.forward
+    '''
+    for i in range(0, len(dataset), trainer.batch_size):
+        batch = dataset[i: i + trainer.batch_size]
+        if len(batch) == 5: # CoNLL
+            text, word_ids, char_ids, tag_ids, word_mask = batch
+            sen_len = torch.max(torch.sum(word_mask, dim = 1, dtype = torch.int64)).item()
+            yield (text, word_ids[:, : sen_len].to(trainer.device), word_mask[:, : sen_len].to(trainer.device),
+                   char_ids[:, : sen_len, :].to(trainer.device), None, tag_ids[:, : sen_len].to(trainer.device))
+        else: # CCKS
+            text, char_ids, char_mask, tag_ids = batch
+            sen_len = max([len(sentence) for sentence in text])
+            yield (text, None, None, char_ids[:, : sen_len].to(trainer.device),
+                   char_mask[:, : sen_len].to(trainer.device), tag_ids[:, : sen_len].to(trainer.device))
+
+def fine_tune(trainer, model, epochs = 3, lr = 1e-4):
+    '''
+    short recovery training of a pruned model on trainer.train_set, the weights with the best valid loss are kept
+    '''
+    optimizer = optim.Adam(model.parameters(), lr = lr)
+    entrophy = nn.CrossEntropyLoss()
+    def loss_of(text, word_ids, word_mask, char_ids, char_mask, tag_ids):
+        if model.use_crf:
+            return model(text, word_ids, word_mask, char_ids, char_mask, tag_ids)
+        output = model(text, word_ids, word_mask, char_ids, char_mask)
+        return entrophy(output.permute(0, 2, 1), tag_ids)
+
+    best_loss, best_state = None, None
+    for epoch in range(epochs):
+        train_losses = []
+        valid_losses = []
+        model.train()
+        for batch in batches(trainer, trainer.train_set):
+            optimizer.zero_grad()
+            loss = loss_of(*batch)
+            train_losses.append(loss.item())
+            loss.backward()
+            optimizer.step()
+        model.eval()
+        with torch.no_grad():
+            for batch in batches(trainer, trainer.valid_set):
+                valid_losses.append(loss_of(*batch).item())
+        avg_train_loss = np.average(train_losses)
+        avg_valid_loss = np.average(valid_losses)
+        logger('[fine-tune {:3d}] train_loss: {:.8f}  valid_loss: {:.8f}'.format(epoch + 1, avg_train_loss, avg_valid_loss))
+        if best_loss is None or avg_valid_loss < best_loss:
+            best_loss, best_state = avg_valid_loss, copy.deepcopy(model.state_dict())
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return model
+
+def plot_curves(results, path):
+    hidden_dims = [results[ratio]['hidden_dim'] for ratio in results]
+    figure, (f1_axis, latency_axis) = plt.subplots(1, 2, figsize = (10, 4))
+    f1_axis.plot(hidden_dims, [results[ratio]['f1'] for ratio in results], marker = 'o')
+    f1_axis.set_xlabel('hidden_dim')
+    f1_axis.set_ylabel('F1')
+    latency_axis.plot(hidden_dims, [results[ratio]['latency'] for ratio in results], marker = 'o')
+    latency_axis.set_xlabel('hidden_dim')
+    latency_axis.set_ylabel('latency (ms / sentence)')
+    figure.tight_layout()
+    figure.savefig(path, format = 'png')
+    plt.close(figure)
+
+def prune_curve(trainer, ratios = (0.0, 0.25, 0.5, 0.75), epochs = 3, path = None):
+    '''
+    prune the trained trainer.model with each ratio, fine-tune and evaluate
+    path: png of the F1 and latency curves, default ./results/prune_{time}.png
+    output:
+        results: {ratio: metrics of Trainer.test with hidden_dim, throughput (tokens/s) and latency (ms / sentence)}
+        models: {ratio: pruned and fine-tuned model}
+    '''
+    base = trainer.model
+    results = {}
+    models = {}
+    for ratio in ratios:
+        model = base
+        if ratio > 0:
+            model = fine_tune(trainer, prune(base, ratio), epochs)
+        trainer.model = model
+        metrics = trainer.test()
+        metrics['hidden_dim'] = model.hidden_dim
+        metrics['throughput'] = throughput(trainer)
+        metrics['latency'] = latency(trainer)
+        results[ratio] = metrics
+        models[ratio] = model
+    trainer.model = base
+
+    for ratio, metrics in results.items():
+        logger('[Prune] ratio: {:.2f}, hidden_dim: {}, F1: {:.8f}, throughput: {:.1f} tokens/s, latency: {:.3f} ms'.format(
+            ratio, metrics['hidden_dim'], metrics['f1'], metrics['throughput'], metrics['latency']))
+    if path is None:
+        os.makedirs('./results', exist_ok = True)
+        path = './results/prune_{}.png'.format(time.strftime('%m%d%H%M', time.localtime()))
+    plot_curves(results, path)
+    logger('Save prune curves to {}'.format(path))
+    return results, models
+
+if __name__ == '__main__':
+    from Train_Chinese import Trainer
+    # fine-tuning needs the train set, Train_Chinese.Trainer trains in __init__
+    trainer = Trainer('train', None, '/data/CCKS2019/', epochs = 100,
+        use_word = False, use_char = True, use_lm = False, use_crf = True, use_lexicon = False,
+        use_pretrained_word = False, use_pretrained_char = False,
+        attention_pooling = False)
+    prune_curve(trainer)
@@ -0,0 +1,90 @@
+import copy
+import io
+import torch
+import torch.nn as nn
+from torch.ao.quantization import default_dynamic_qconfig, float_qparams_weight_only_qconfig, quantize_dynamic
+
+from Benchmark import throughput
+from Utils import logger
+
+class FlatEmbedding(nn.Module):
+    '''
+    quantized embedding ops accept 1d or 2d indices only, char_ids of English NER are 3d
+    '''
+    def __init__(self, embedding):
+        super().__init__()
+        self.embedding = embedding
+
+    def forward(self, ids):
+        emb = self.embedding(ids.reshape(-1))
+        return emb.reshape(*ids.shape, emb.shape[-1])
+
+def quantize(model):
+    '''
+    dynamic int8 quantization of a trained BiLSTM_CRF for CPU inference
+    the lstm and hidden2tag are quantized with dynamic activations, the embedding tables with per-row weights,
+    the crf and the LM stay in fp32
+    output:
+        int8 model, the fp32 model is not modified
+    '''
+    qconfig_spec = {}
+    for name, module in model.named_modules():
+        if name.startswith('lm_embeds'):
+            continue
+        if isinstance(module, (nn.LSTM, nn.Linear)) and name.split('.')[-1] in ('lstm', 'hidden2tag'):
+            qconfig_spec[name] = default_dynamic_qconfig
+        elif isinstance(module, nn.Embedding):
+            qconfig_spec[name] = float_qparams_weight_only_qconfig
+    model = copy.deepcopy(model).cpu().eval()
+    model = quantize_dynamic(model, qconfig_spec, dtype = torch.qint8)
+    for name in qconfig_spec:
+        if qconfig_spec[name] is float_qparams_weight_only_qconfig:
+            parent_name, _, child_name = name.rpartition('.')
+            parent = model.get_submodule(parent_name)
+            setattr(parent, child_name, FlatEmbedding(getattr(parent, child_name)))
+    return model
+
+def model_size(model):
+    '''
+    bytes of the serialized state dict
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def compare_quantized(trainer):
+    '''
+    run Trainer.test and the throughput benchmark with the fp32 and int8 models on CPU
+    output:
+        results: {'fp32': metrics, 'int8': metrics}, metrics of Trainer.test with throughput (tokens/s) and size (bytes)
+    '''
+    trainer.device = 'cpu'
+    fp32_model = trainer.model.cpu().eval()
+    int8_model = quantize(fp32_model)
+    results = {}
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        trainer.model = model
+        metrics = trainer.test()
+        metrics['throughput'] = throughput(trainer)
+        metrics['size'] = model_size(model)
+        results[name] = metrics
+    trainer.model = fp32_model
+
+    for name, metrics in results.items():
+        logger('[Quantize] {}: throughput: {:.1f} tokens/s, size: {:.2f} MB'.format(
+            name, metrics['throughput'], metrics['size'] / 1024 / 1024))
+        for key in sorted(key for key in metrics if key not in ('throughput', 'size')):
+            logger('[Quantize] {}: {}: {:.8f}'.format(name, key, metrics[key]))
+    logger('[Quantize] speedup: {:.2f}x, size: {:.2f}x, F1 diff: {:.8f}'.format(
+        results['int8']['throughput'] / results['fp32']['throughput'],
+        results['int8']['size'] / results['fp32']['size'],
+        results['int8']['f1'] - results['fp32']['f1']))
+    return results
+
+if __name__ == '__main__':
+    from Train_Chinese import Trainer
+    trainer = Trainer('test', '01041630', '/data/CCKS2019/', epochs = 100,
+        use_word = False, use_char = True, use_lm = False, use_crf = True, use_lexicon = False,
+        use_pretrained_word = False, use_pretrained_char = False,
+        attention_pooling = False)
+    compare_quantized(trainer)
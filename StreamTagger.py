@@ -0,0 +1,122 @@
+from collections import deque
+import torch
+
+from ConllData import padding_chars
+from crf import FixedLagViterbi
+
+def read_chars(path, chunk_size = 4096):
+    '''
+    read a document character by character without loading it into memory
+    '''
+    with open(path, 'r', encoding = 'utf-8') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            for char in chunk:
+                yield char
+
+
+class StreamTagger():
+    def __init__(self, model, vocab, window = 128, context = 16, lag = 16, max_word_len = 16):
+        '''
+        tag documents of any length with bounded memory
+        the encoder runs on overlapping windows, every token is encoded with up to context tokens on each side,
+        and tags are committed by fixed-lag viterbi decoding across window boundaries
+        input:
+            model:      BiLSTM_CRF with use_crf
+            vocab:      CCKSVocab (char level) or WordVocab (word level, if model.use_word)
+            window:     max number of tokens encoded at once
+            context:    tokens of context kept on each side of a window
+            lag:        number of tokens seen after a token before its tag is committed
+            max_word_len: chars of each word are padded and truncated to max_word_len, as ConllDataset does (word level)
+        '''
+        if window <= 2 * context:
+            raise ValueError('window ({}) must be larger than 2 * context ({}).'.format(window, 2 * context))
+        self.model = model
+        self.vocab = vocab
+        self.window = window
+        self.context = context
+        self.lag = lag
+        self.max_word_len = max_word_len
+        self.step_size = window - 2 * context
+        self.device = next(model.parameters()).device
+
+    def encode(self, tokens):
+        '''
+        input:
+            tokens: list of char or word
+        output:
+            emissions: (len(tokens), tagset_size)
+        '''
+        text = [list(tokens)]
+        word_ids, word_mask, char_ids, char_mask = None, None, None, None
+        if self.model.use_word: # English NER
+            word_ids = torch.tensor([self.vocab.map_word(text[0], dim = 2)], dtype = torch.long, device = self.device)
+            word_mask = torch.ones_like(word_ids, dtype = torch.bool)
+            # the same char width as in training, the char cnn output depends on it
+            char_ids, _ = padding_chars(self.vocab.map_char(text[0], dim = 2), self.max_word_len, padding_value = 0)
+            char_ids = torch.tensor([char_ids], dtype = torch.long, device = self.device)
+        else: # Chinese NER
+            char_ids = torch.tensor([self.vocab.map_char(text[0], dim = 2)], dtype = torch.long, device = self.device)
+            char_mask = torch.ones_like(char_ids, dtype = torch.bool)
+        with torch.no_grad():
+            emissions, _ = self.model._get_emissions(text, word_ids, word_mask, char_ids, char_mask)
+        return emissions[0]
+
+    def tag(self, stream):
+        '''
+        input:
+            stream: iterable of tokens, e.g. a str or read_chars(path)
+        output:
+            generator of (token, tag_id)
+        '''
+        self.model.eval()
+        decoder = FixedLagViterbi(self.model.crf, self.lag)
+        buffer = deque() # [left context | tokens to encode | right context]
+        pending = deque() # encoded tokens waiting for their tags
+        left = 0
+        for token in stream:
+            buffer.append(token)
+            if len(buffer) - left < self.step_size + self.context:
+                continue
+            tokens = list(buffer)
+            emissions = self.encode(tokens)[left: left + self.step_size]
+            pending.extend(tokens[left: left + self.step_size])
+            for tag in decoder.step(emissions):
+                yield pending.popleft(), tag
+            # keep the end of the encoded tokens as left context of the next window
+            keep = min(self.context, left + self.step_size)
+            for _ in range(left + self.step_size - keep):
+                buffer.popleft()
+            left = keep
+        tokens = list(buffer)
+        if len(tokens) > left:
+            emissions = self.encode(tokens)[left:]
+            pending.extend(tokens[left:])
+            tags = decoder.step(emissions)
+        else:
+            tags = []
+        for tag in tags + decoder.flush():
+            yield pending.popleft(), tag
+
+    def entities(self, stream):
+        '''
+        input:
+            stream: iterable of tokens
+        output:
+            generator of entity dict, the same format as label_chinese_entity, positions are offsets in the document
+        '''
+        ix_to_tag = self.model.tag_vocab.ix_to_tag
+        entity = None
+        for i, (token, tag_id) in enumerate(self.tag(stream)):
+            tag = ix_to_tag[tag_id]
+            if tag.startswith('B-'):
+                entity = {"text": [token], "start_pos": i, "label": tag[2:]}
+            elif tag.startswith('I-') and entity is not None:
+                entity["text"].append(token)
+            elif tag.startswith('E-') and entity is not None:
+                yield {"text": ''.join(entity["text"] + [token]), "start_pos": entity["start_pos"], "end_pos": i + 1, "label": entity["label"]}
+                entity = None
+            elif tag.startswith('S-'):
+                yield {"text": token, "start_pos": i, "end_pos": i + 1, "label": tag[2:]}
+                entity = None
+            else:
+                entity = None
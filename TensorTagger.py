@@ -0,0 +1,155 @@
+from typing import Optional
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from crf import viterbi_decode_batch
+
+class TensorTagger(nn.Module):
+    '''
+    tensor-only inference path of a trained BiLSTM_CRF, can be compiled by torch.jit.script
+    shares the parameters of the model, the crf transitions are frozen with BIOES constraints
+    texts must be mapped to ids (and lexicon type ids) before calling, LMEmbedding is not supported
+    '''
+    use_word: torch.jit.Final[bool]
+    use_char: torch.jit.Final[bool]
+    use_lexicon: torch.jit.Final[bool]
+    use_crf: torch.jit.Final[bool]
+    use_idcnn: torch.jit.Final[bool]
+    char_pooling: torch.jit.Final[str]
+    num_blocks: torch.jit.Final[int]
+
+    def __init__(self, model):
+        super().__init__()
+        if model.use_lm:
+            raise ValueError('LMEmbedding needs raw text, TensorTagger supports models with use_lm = False only.')
+        if model.use_word and not isinstance(model.word_embeds.word_embeds, nn.Embedding):
+            raise ValueError('Out-of-core word embeddings are read with numpy, TensorTagger needs an nn.Embedding word table.')
+        self.use_word = model.use_word
+        self.use_char = model.use_char
+        self.use_lexicon = model.use_lexicon
+        self.use_crf = model.use_crf
+        self.use_idcnn = model.encoder == 'idcnn'
+
+        self.word_embeds = model.word_embeds.word_embeds if model.use_word else None
+        self.char_embeds = model.char_embeds.char_embeds if model.use_char else None
+        self.char_cnn = None
+        self.atten_pool = None
+        self.char_pooling = 'none' # pretrained char embeddings are looked up only
+        if model.use_char and not model.char_embeds.use_pretrained_char:
+            if model.char_embeds.use_cnn:
+                self.char_cnn = model.char_embeds.cnn
+            if model.char_embeds.attention_pooling:
+                self.atten_pool = model.char_embeds.atten_pool
+                self.char_pooling = 'attention'
+            else:
+                self.char_pooling = 'max'
+        self.lexicon_embeds = model.lexicon_embeds.lexicon_embeds if model.use_lexicon else None
+
+        if self.use_idcnn:
+            self.lstm = None
+            self.input_conv = model.idcnn.input_conv
+            self.block = model.idcnn.block
+            self.num_blocks = model.idcnn.num_blocks
+            self.hidden2tag = model.idcnn.hidden2tag
+        else:
+            self.lstm = model.bilstm.lstm
+            self.input_conv = None
+            self.block = nn.ModuleList()
+            self.num_blocks = 0
+            self.hidden2tag = model.bilstm.hidden2tag
+
+        if model.use_crf:
+            transitions, start_transitions, end_transitions = model.crf._constrained_transitions()
+        else:
+            transitions = start_transitions = end_transitions = torch.zeros(0)
+        self.register_buffer('transitions', transitions.clone())
+        self.register_buffer('start_transitions', start_transitions.clone())
+        self.register_buffer('end_transitions', end_transitions.clone())
+
+    def char_embedding(self, char_ids):
+        '''
+        the inference path of CharEmbedding.forward
+        '''
+        assert self.char_embeds is not None
+        char_emb = self.char_embeds(char_ids)
+        if self.char_pooling == 'none':
+            return char_emb
+        dim = char_ids.dim()
+        if dim == 2:
+            char_emb = char_emb.unsqueeze(2) # (batch_size, max_sen_len, 1, embed_size)
+        batch_size, max_sen_len, max_word_len, emb_size = char_emb.shape
+        if self.char_cnn is not None:
+            char_emb = char_emb.reshape(batch_size * max_sen_len, max_word_len, emb_size).permute(0, 2, 1)
+            char_emb = self.char_cnn(char_emb)
+            char_emb = char_emb.reshape(batch_size, max_sen_len, -1, emb_size)
+        if dim == 2:
+            return char_emb.squeeze(2)
+        if self.atten_pool is not None:
+            return self.atten_pool(char_emb)
+        return torch.max(char_emb, dim = 2).values
+
+    def encode(self, embeds, word_mask):
+        '''
+        the inference path of BiLSTM.forward and IDCNN.forward
+        '''
+        if self.use_idcnn:
+            assert self.input_conv is not None
+            mask = word_mask.unsqueeze(1).to(embeds.dtype)
+            hidden = torch.relu(self.input_conv(embeds.transpose(1, 2) * mask)) * mask
+            for _ in range(self.num_blocks):
+                for conv in self.block:
+                    hidden = torch.relu(conv(hidden)) * mask
+            return self.hidden2tag(hidden.transpose(1, 2))
+        assert self.lstm is not None
+        sen_len = torch.sum(word_mask, dim = 1, dtype = torch.int64).to('cpu')
+        pack_seq = pack_padded_sequence(embeds, sen_len, batch_first = True, enforce_sorted = False)
+        lstm_out, _ = self.lstm(pack_seq)
+        lstm_out, _ = pad_packed_sequence(lstm_out, batch_first = True, total_length = embeds.size(1))
+        return self.hidden2tag(lstm_out)
+
+    def emissions(self, word_ids: Optional[torch.Tensor], word_mask: Optional[torch.Tensor],
+                  char_ids: Optional[torch.Tensor], char_mask: Optional[torch.Tensor],
+                  lexicon_type_ids: Optional[torch.Tensor] = None):
+        '''
+        output:
+            emissions: (batch_size, sen_len, tagset_size)
+            word_mask: (batch_size, sen_len)
+        '''
+        embeds = []
+        if self.use_word:
+            assert self.word_embeds is not None and word_ids is not None
+            embeds.append(self.word_embeds(word_ids))
+        if self.use_char:
+            assert char_ids is not None
+            embeds.append(self.char_embedding(char_ids))
+            if char_ids.dim() == 2: # no word embedding
+                word_mask = char_mask
+        if self.use_lexicon:
+            assert self.lexicon_embeds is not None and lexicon_type_ids is not None
+            embeds.append(self.lexicon_embeds(lexicon_type_ids))
+        assert word_mask is not None
+        return self.encode(torch.cat(embeds, dim = -1), word_mask), word_mask
+
+    def forward(self, word_ids: Optional[torch.Tensor], word_mask: Optional[torch.Tensor],
+                char_ids: Optional[torch.Tensor], char_mask: Optional[torch.Tensor],
+                lexicon_type_ids: Optional[torch.Tensor] = None):
+        '''
+        input:
+            dim == 3: (English NER)
+                word_ids:   (batch_size, sen_len)
+                word_mask:  (batch_size, sen_len)
+                char_ids:   (batch_size, sen_len, max_word_len)
+            dim == 2: (Chinese NER)
+                char_ids:   (batch_size, sen_len)
+                char_mask:  (batch_size, sen_len)
+            lexicon_type_ids: (batch_size, sen_len), output of LexiconVocab.map_batch_to_typeid, if use_lexicon
+        output:
+            predict: (batch_size, sen_len), padded tokens are 0
+        '''
+        emissions, mask = self.emissions(word_ids, word_mask, char_ids, char_mask, lexicon_type_ids)
+        mask = mask.to(torch.bool)
+        if not self.use_crf:
+            return emissions.argmax(2) * mask.long()
+        best_paths, _ = viterbi_decode_batch(emissions, mask, self.transitions, self.start_transitions, self.end_transitions)
+        return best_paths
@@ -22,7 +22,7 @@ class Trainer():
         mod = 'train', model_time = None, data_path = None, epochs = 100, 
         use_word = True, use_char = True, use_lm = True, use_crf = True, use_cnn = True, 
         use_pretrained_word = True, use_pretrained_char = True, 
-        attention_pooling = False
+        attention_pooling = False, crf_bypass = False, bypass_margin = None, encoder = 'bilstm', use_packed = False, use_checkpoint = False, use_compile = False, lm_cache_dir = None, lm_shared_dir = None, out_of_core_word = False
         ):
         super().__init__()
         self.mod = mod
@@ -54,10 +54,11 @@ class Trainer():
         logger('device = {}'.format(self.device))
         logger('use_word = {}, use_char = {}, use_lm = {}, use_lexicon = {}'.format(use_word, use_char, use_lm, self.use_lexicon))
         # logger('use_crf = {}, use_cnn = {}, atten_pool = {}'.format(use_crf, use_cnn, attention_pooling))
-        logger('use_pretrained_word = {}, use_pretrained_char = {}'.format(use_pretrained_word, use_pretrained_char))
+        logger('use_pretrained_word = {}, use_pretrained_char = {}, out_of_core_word = {}'.format(use_pretrained_word, use_pretrained_char, out_of_core_word))
+        logger('encoder = {}, use_packed = {}, use_checkpoint = {}, use_compile = {}, crf_bypass = {}, bypass_margin = {}'.format(encoder, use_packed, use_checkpoint, use_compile, crf_bypass, bypass_margin))
         logger('dataset_path = {}'.format(data_path))
         
-        self.load_data(data_path, mod)
+        self.load_data(data_path, mod, out_of_core_word)
 
         self.model = BiLSTM_CRF(
             self.word_vocab, self.tag_vocab, 
@@ -65,11 +66,11 @@ class Trainer():
             self.batch_size, self.device, self.dropout, 
             use_word = use_word, use_char = use_char, use_lm = use_lm, use_crf = use_crf, use_cnn = use_cnn, use_lexicon = False,
             use_pretrained_word = use_pretrained_word, use_pretrained_char = use_pretrained_char, 
-            attention_pooling = attention_pooling
+            attention_pooling = attention_pooling, crf_bypass = crf_bypass, bypass_margin = bypass_margin, encoder = encoder, use_packed = use_packed, use_checkpoint = use_checkpoint, use_compile = use_compile, lm_cache_dir = lm_cache_dir, lm_shared_dir = lm_shared_dir
         ).to(self.device)
 
-    def load_data(self, data_path, mod = 'train'):
-        self.word_vocab = WordVocab(data_path)
+    def load_data(self, data_path, mod = 'train', out_of_core_word = False):
+        self.word_vocab = WordVocab(data_path, out_of_core = out_of_core_word)
         self.tag_vocab = TagVocab(['LOC', 'MISC', 'ORG', 'PER'])
         if mod == 'train':
             self.train_set = ConllDataset(data_path + 'eng.train', self.word_vocab, self.tag_vocab)
@@ -208,7 +209,10 @@ class Trainer():
             recall = correct_num / (gold_num + 0.000000001)
             f1 = 2 * precision * recall / (precision + recall + 0.000000001)
             logger('[Test] Tagging accuracy: {:.8f}'.format(correct / total))
+            if self.use_crf and model.crf_bypass:
+                logger('[Test] CRF bypass ratio: {:.4f}'.format(model.bypass_ratio()))
             logger('[Test] Precision: {:.8f} Recall: {:.8f} F1: {:.8f}'.format(precision, recall, f1))
+            return {'precision': precision, 'recall': recall, 'f1': f1}
             
     def test_with_rule(self):
         model = self.model
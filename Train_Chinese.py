@@ -22,7 +22,7 @@ class Trainer():
         mod = 'train', model_time = None, data_path = None, epochs = 100, 
         use_word = True, use_char = True, use_lm = True, use_crf = True, use_cnn = True, use_lexicon = True, 
         use_pretrained_word = True, use_pretrained_char = True, 
-        attention_pooling = False
+        attention_pooling = False, crf_bypass = False, bypass_margin = None, encoder = 'bilstm', use_packed = False, use_checkpoint = False, use_compile = False, lm_cache_dir = None, lm_shared_dir = None
         ):
         super().__init__()
 
@@ -53,6 +53,7 @@ class Trainer():
         logger('device = {}'.format(self.device))
         logger('use_word = {}, use_char = {}, use_lm = {}, use_crf = {}, use_cnn = {}, use_lexicon = {}, atten_pool = {}'.format(use_word, use_char, use_lm, use_crf, use_cnn, use_lexicon, attention_pooling))
         logger('use_pretrained_word = {}, use_pretrained_char = {}'.format(use_pretrained_word, use_pretrained_char))
+        logger('encoder = {}, use_packed = {}, use_checkpoint = {}, use_compile = {}, crf_bypass = {}, bypass_margin = {}'.format(encoder, use_packed, use_checkpoint, use_compile, crf_bypass, bypass_margin))
         logger('dataset_path = {}'.format(data_path))
         #logger('pretrained_path = {}'.format(pretrained_path))
 
@@ -82,7 +83,7 @@ class Trainer():
             self.batch_size, self.device, self.dropout, 
             use_word = use_word, use_char = use_char, use_lm = use_lm, use_crf = use_crf, use_cnn = use_cnn, use_lexicon = use_lexicon,
             use_pretrained_word = use_pretrained_word, use_pretrained_char = use_pretrained_char, 
-            attention_pooling = attention_pooling
+            attention_pooling = attention_pooling, crf_bypass = crf_bypass, bypass_margin = bypass_margin, encoder = encoder, use_packed = use_packed, use_checkpoint = use_checkpoint, use_compile = use_compile, lm_cache_dir = lm_cache_dir, lm_shared_dir = lm_shared_dir
         ).to(self.device)
 
         if mod == 'train':
@@ -257,15 +258,20 @@ class Trainer():
             recall = correct_num / (gold_num + 0.000000001)
             f1 = 2 * precision * recall / (precision + recall + 0.000000001)
             logger('[Test] Tagging accuracy: {:.8f}'.format(correct / total))
+            if self.use_crf and model.crf_bypass:
+                logger('[Test] CRF bypass ratio: {:.4f}'.format(model.bypass_ratio()))
             logger('[Test] Precisely matching:')
             logger('[Test] Precision: {:.8f} Recall: {:.8f} F1: {:.8f}'.format(precision, recall, f1))
+            result = {'precision': precision, 'recall': recall, 'f1': f1}
             precision = relax_correct_num / (predict_num + 0.000000001)
             recall = relax_correct_num / (gold_num + 0.000000001)
             f1 = 2 * precision * recall / (precision + recall + 0.000000001)
             logger('[Test] Relaxation matching:')
             logger('[Test] Precision: {:.8f} Recall: {:.8f} F1: {:.8f}'.format(precision, recall, f1))
+            result.update({'relax_precision': precision, 'relax_recall': recall, 'relax_f1': f1})
+            return result
     
-    def test_with_lexicon(self, use_rule = False):
+    def test_with_lexicon(self, use_rule = False, force_lexicon = False):
         model = self.model
         model.eval()
         gold_num, predict_num, correct_num = 0, 0, 0
@@ -291,17 +297,18 @@ class Trainer():
                 char_mask = char_mask[:, : sen_len].to(self.device)
                 
                 if self.use_crf:
-                    predict = model(text, None, None, char_ids, char_mask) # (batch_size, sen_len)
+                    predict = model.predict_with_lexicon(text, None, None, char_ids, char_mask, self.lexicon_vocab, use_rule, force_lexicon) # (batch_size, sen_len)
                 else:
                     output = model(text, None, None, char_ids, char_mask) # (batch_size, sen_len, tagset_size)
                     predict = torch.max(output, dim = 2).indices # (batch_size, sen_len)
+                    if force_lexicon:
+                        type_ids = self.lexicon_vocab.map_batch_to_typeid(text, use_rule)
+                        tag_observations = self.lexicon_vocab.map_typeids_to_tag_observations(type_ids).to(self.device)
+                        predict = torch.where(tag_observations == -1, predict, tag_observations)
                 correct += torch.sum(predict[char_mask] == tag_ids[char_mask]).item()
                 total += torch.sum(char_mask).item()
                 
                 for j in range(tag_ids.shape[0]):
-                    new_tag_id = self.lexicon_vocab.clean_tagid_with_lexicon(''.join(text[j]), tag_ids[j], use_rule)
-                    print(new_tag_id)
-                    1()
                     gold_entity = label_chinese_entity(text[j], tag_ids[j].tolist(), self.tag_vocab.ix_to_tag)
                     pred_entity = label_chinese_entity(text[j], predict[j], self.tag_vocab.ix_to_tag)
                     gold_num += len(gold_entity)
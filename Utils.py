@@ -1,4 +1,6 @@
 import copy
+import hashlib
+import os
 import sys
 import time
 import torch
@@ -90,10 +92,13 @@ def label_batch_entity(tags, tag_list, scheme="BIOES"):
     for i in tags.shape[0]:
         entity += label_sentence_entity(tags[i], tag_list, scheme)
 
-def label_chinese_entity(text, tags, tag_list):
+def label_chinese_entity(text, tags, tag_list, confidence = None):
     # [start, end)
+    # confidence: (sen_len), output of CRF.entity_confidence, add 'confidence' to each entity if given
     if type(tags) == torch.Tensor:
         tags = tags.tolist()
+    if type(confidence) == torch.Tensor:
+        confidence = confidence.tolist()
     tags = [tag_list[tag] for tag in tags]
     entity = []
     count = len(tags)
@@ -112,6 +117,8 @@ def label_chinese_entity(text, tags, tag_list):
                 "end_pos": j + 1,
                 "label": tags[i][2:]
             })
+            if confidence is not None:
+                entity[-1]["confidence"] = confidence[i]
             i = j + 1
         elif tags[i].startswith("S-"):
             entity.append({
@@ -120,6 +127,8 @@ def label_chinese_entity(text, tags, tag_list):
                 "end_pos": i + 1,
                 "label": tags[i][2:]
             })
+            if confidence is not None:
+                entity[-1]["confidence"] = confidence[i]
             i += 1
         else:
             i += 1
@@ -164,6 +173,20 @@ def logger(content):
     sys.stdout.write('[{}] {}\n'.format(time_stamp, content))
     sys.stderr.write('[{}] {}\n'.format(time_stamp, content))
 
+def model_key(*paths):
+    '''
+    identity of model files: content of small files, name, size and mtime of large ones
+    '''
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        if stat.st_size < 1 << 20:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        else:
+            digest.update('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()[: 16]
+
 def get_charset(sentences):
     # [[word1, word2, ..., word n], [], ...]
     char_set = set()
@@ -1,15 +1,52 @@
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 #from CharEmbedding import CharEmbedding
 from Utils import logger
 
+class MmapEmbedding(nn.Module):
+    '''
+    frozen embedding table in a memory-mapped .npy file, e.g. the full pretrained table of ConllData.convert_pretrained,
+    only the rows of the words of a batch are read, the table is not part of the state dict
+    '''
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.table = None # np.memmap, mapped again by copies of the model
+        self.num_embeddings, self.embedding_dim = np.load(path, mmap_mode = 'r').shape
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['table'] = None
+        return state
+
+    @torch.compiler.disable
+    def forward(self, word_ids):
+        '''
+        input:
+            word_ids: (batch_size, max_sen_len)
+        output:
+            word_embeds: (batch_size, max_sen_len, embedding_dim)
+        '''
+        if self.table is None:
+            self.table = np.load(self.path, mmap_mode = 'r')
+        unique_ids, inverse = torch.unique(word_ids, return_inverse = True)
+        rows = torch.from_numpy(self.table[unique_ids.cpu().numpy()]).to(word_ids.device) # (num_unique, embedding_dim)
+        return F.embedding(inverse, rows)
+
 class WordEmbedding(nn.Module):
     def __init__(self, word_vocab, word_emb_dim = 256, use_pretrained_word = True, fine_tune = False):
         super().__init__()
         self.word_vocab = word_vocab
         self.n_words = len(word_vocab.word_to_ix)
         self.fine_tune = False
-        if use_pretrained_word:
+        if use_pretrained_word and getattr(word_vocab, 'out_of_core', False):
+            self.word_embeds = MmapEmbedding(word_vocab.word_emb_path)
+            self.word_emb_dim = self.word_embeds.embedding_dim
+            logger('Load out-of-core word embedding {}, fine-tune = False. Shape: {}'.format(
+                word_vocab.word_emb_path, (self.word_embeds.num_embeddings, self.word_emb_dim)))
+        elif use_pretrained_word:
             self.word_emb_dim = word_vocab.word_emb.shape[1]
             self.word_emb = word_vocab.word_emb
             self.word_embeds = nn.Embedding.from_pretrained(self.word_emb, freeze = not self.fine_tune)
@@ -1,5 +1,11 @@
+from collections import deque
+from typing import List
 import torch
 import torch.nn as nn
+from torch.autograd.function import once_differentiable
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+from crf_numpy import NumpyCRFDecoder
 
 def logsumexp(tensor, dim=-1, keepdim=False):
     max_score, _ = tensor.max(dim, keepdim=keepdim)
@@ -53,6 +59,282 @@ def viterbi_decode(tag_sequence, transition_matrix, tag_observations=None):
     viterbi_path.reverse()
     return viterbi_path, viterbi_score
 
+def viterbi_decode_batch(logits, mask, transitions, start_transitions, end_transitions):
+    '''
+    batched viterbi decoding, the recursion runs over the whole batch at each timestep
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+    output:
+        best_paths: (batch_size, sen_len), padded tokens are 0
+        best_scores: (batch_size)
+    '''
+    batch_size, sequence_length, num_tags = logits.size()
+    mask = mask.to(torch.bool)
+    # identity backpointers keep the tag of finished sequences unchanged
+    identity = torch.arange(num_tags, device = logits.device).view(1, num_tags).expand(batch_size, num_tags)
+    # score: (batch_size, num_tags)
+    score = logits[:, 0] + start_transitions.view(1, num_tags)
+    backpointers = []
+    for i in range(1, sequence_length):
+        # inner: (batch_size, from_tag, to_tag)
+        inner = score.unsqueeze(2) + transitions.unsqueeze(0)
+        best_score, best_tag = inner.max(1)
+        step_mask = mask[:, i].unsqueeze(1)
+        score = torch.where(step_mask, best_score + logits[:, i], score)
+        backpointers.append(torch.where(step_mask, best_tag, identity))
+    score = score + end_transitions.view(1, num_tags)
+    best_scores, best_tag = score.max(1)
+    return backtrack(backpointers, best_tag, mask), best_scores
+
+def backtrack(backpointers, best_tag, mask):
+    # type: (List[torch.Tensor], torch.Tensor, torch.Tensor) -> torch.Tensor
+    '''
+    construct the most likely sequences backwards
+    backpointers: list of (batch_size, num_tags), sen_len - 1 timesteps
+    best_tag: (batch_size), tag of the last timestep
+    mask: (batch_size, sen_len)
+    output:
+        best_paths: (batch_size, sen_len), padded tokens are 0
+    '''
+    batch_size, sequence_length = mask.size()
+    best_paths = torch.zeros(batch_size, sequence_length, dtype = torch.long, device = best_tag.device)
+    best_paths[:, sequence_length - 1] = best_tag
+    for i in range(sequence_length - 2, -1, -1):
+        best_tag = backpointers[i].gather(1, best_tag.unsqueeze(1)).squeeze(1)
+        best_paths[:, i] = best_tag
+    return best_paths * mask.long()
+
+def viterbi_topk_batch(logits, mask, transitions, start_transitions, end_transitions, k):
+    '''
+    batched k-best viterbi decoding, each tag keeps its k best partial paths
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags), -inf for forbidden transitions
+        start_transitions & end_transitions: (num_tags)
+        k: number of paths
+    output:
+        best_paths: (batch_size, k, sen_len), padded tokens are 0, -1 for every token of a rank without a finite path
+        best_scores: (batch_size, k), in descending order, -inf if there are less than k paths
+    '''
+    batch_size, sequence_length, num_tags = logits.size()
+    mask = mask.bool()
+    # index (from_tag * k + rank) of every partial path, used as backpointer of finished sequences
+    identity = torch.arange(num_tags * k, device = logits.device).view(1, num_tags, k).expand(batch_size, num_tags, k)
+    # score: (batch_size, num_tags, k), only rank 0 is a real path at the first timestep
+    score = logits.new_full((batch_size, num_tags, k), float('-inf'))
+    score[:, :, 0] = logits[:, 0] + start_transitions.view(1, num_tags)
+    backpointers = []
+    for i in range(1, sequence_length):
+        # inner: (batch_size, from_tag * k, to_tag)
+        inner = score.unsqueeze(3) + transitions.view(1, num_tags, 1, num_tags)
+        inner = inner.reshape(batch_size, num_tags * k, num_tags)
+        best_score, best_index = inner.topk(k, dim = 1)
+        # (batch_size, to_tag, k)
+        best_score = best_score.transpose(1, 2)
+        best_index = best_index.transpose(1, 2)
+        step_mask = mask[:, i].view(batch_size, 1, 1)
+        score = torch.where(step_mask, best_score + logits[:, i].unsqueeze(2), score)
+        backpointers.append(torch.where(step_mask, best_index, identity))
+    score = score + end_transitions.view(1, num_tags, 1)
+    best_scores, best_index = score.reshape(batch_size, num_tags * k).topk(k, dim = 1)
+
+    # Construct the k most likely sequences backwards.
+    best_paths = torch.zeros(batch_size, k, sequence_length, dtype = torch.long, device = logits.device)
+    best_paths[:, :, sequence_length - 1] = best_index // k
+    for i in range(sequence_length - 2, -1, -1):
+        best_index = backpointers[i].reshape(batch_size, num_tags * k).gather(1, best_index)
+        best_paths[:, :, i] = best_index // k
+    best_paths = best_paths * mask.long().unsqueeze(1)
+    # ranks without a path of finite score, e.g. less than k paths or forbidden transitions at -inf
+    best_paths = best_paths.masked_fill(torch.isinf(best_scores).unsqueeze(2), -1)
+    return best_paths, best_scores
+
+def forward_backward(logits, mask, transitions, start_transitions, end_transitions, with_beta = True):
+    '''
+    batched forward-backward algorithm
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+        with_beta: run the backward pass, otherwise beta is None
+    output:
+        alpha: (batch_size, sen_len, num_tags), log score of all prefixes ending with each tag
+        beta: (batch_size, sen_len, num_tags), log score of all suffixes following each tag
+        log_partition: (batch_size)
+    '''
+    batch_size, sequence_length, num_tags = logits.size()
+    mask = mask.bool()
+    alphas = [logits[:, 0] + start_transitions.view(1, num_tags)]
+    for i in range(1, sequence_length):
+        # inner: (batch_size, from_tag, to_tag)
+        inner = alphas[-1].unsqueeze(2) + transitions.unsqueeze(0)
+        alpha = logsumexp(inner, 1) + logits[:, i]
+        # if mask == 0, then keep alpha unchanged
+        alphas.append(torch.where(mask[:, i].unsqueeze(1), alpha, alphas[-1]))
+    log_partition = logsumexp(alphas[-1] + end_transitions.view(1, num_tags))
+    if not with_beta:
+        return torch.stack(alphas, dim = 1), None, log_partition
+    end_beta = end_transitions.view(1, num_tags).expand(batch_size, num_tags)
+    betas = [end_beta]
+    for i in range(sequence_length - 2, -1, -1):
+        # inner: (batch_size, from_tag, to_tag)
+        inner = transitions.unsqueeze(0) + (logits[:, i + 1] + betas[-1]).unsqueeze(1)
+        beta = logsumexp(inner, 2)
+        # the last token of a sequence is only followed by END
+        betas.append(torch.where(mask[:, i + 1].unsqueeze(1), beta, end_beta))
+    betas.reverse()
+    return torch.stack(alphas, dim = 1), torch.stack(betas, dim = 1), log_partition
+
+def path_score(logits, tags, mask, transitions, start_transitions, end_transitions):
+    '''
+    score of the given tag paths, without loops over timesteps
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        tags: (batch_size, sen_len)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+    output:
+        score: (batch_size)
+    '''
+    batch_size = logits.size(0)
+    mask = mask.float()
+    # emit_score: (batch_size, sen_len)
+    emit_score = logits.gather(2, tags.unsqueeze(2)).squeeze(2)
+    # transition_score: (batch_size, sen_len - 1)
+    transition_score = transitions[tags[:, :-1], tags[:, 1:]]
+    last_tag_index = mask.sum(1).long() - 1
+    last_tags = tags.gather(1, last_tag_index.view(batch_size, 1)).squeeze(1)
+    score = start_transitions.index_select(0, tags[:, 0])
+    score = score + (emit_score * mask).sum(1) + (transition_score * mask[:, 1:]).sum(1)
+    score = score + end_transitions.index_select(0, last_tags)
+    return score
+
+class CRFLogLikelihood(torch.autograd.Function):
+    '''
+    fused CRF log likelihood, summed over the batch
+    no graph is recorded in forward, backward computes the gradients from forward-backward marginals
+    the beta pass only runs if a gradient is needed, e.g. not for validation under no_grad
+    weights: (batch_size), weight of each sentence in the sum, 1 if None
+    '''
+    @staticmethod
+    def forward(ctx, logits, tags, mask, transitions, start_transitions, end_transitions, weights = None):
+        mask = mask.bool()
+        needs_grad = any(ctx.needs_input_grad)
+        alpha, beta, log_partition = forward_backward(logits, mask, transitions, start_transitions, end_transitions, needs_grad)
+        score = path_score(logits, tags, mask, transitions, start_transitions, end_transitions)
+        if weights is None:
+            weights = torch.ones_like(log_partition)
+        if needs_grad:
+            ctx.save_for_backward(logits, tags, mask, transitions, alpha, beta, log_partition, weights)
+        return torch.sum((score - log_partition) * weights)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        logits, tags, mask, transitions, alpha, beta, log_partition, weights = ctx.saved_tensors
+        batch_size, sequence_length, num_tags = logits.size()
+        last_tag_index = mask.sum(1).long() - 1
+        # every gradient term is masked per token, the weights of the sentences are folded into the mask
+        mask = mask.to(logits.dtype) * weights.view(batch_size, 1)
+        log_partition = log_partition.view(batch_size, 1, 1)
+        # unary: (batch_size, sen_len, num_tags), tag marginals
+        unary = (alpha + beta - log_partition).exp() * mask.unsqueeze(2)
+        gold_unary = torch.zeros_like(unary).scatter_(2, tags.unsqueeze(2), 1.) * mask.unsqueeze(2)
+        grad_logits = gold_unary - unary
+
+        # pairwise: (batch_size, sen_len - 1, from_tag, to_tag), transition marginals
+        pairwise = alpha[:, :-1].unsqueeze(3) + transitions.view(1, 1, num_tags, num_tags) + \
+                   (logits[:, 1:] + beta[:, 1:]).unsqueeze(2) - log_partition.unsqueeze(3)
+        pairwise = pairwise.exp() * mask[:, 1:].view(batch_size, -1, 1, 1)
+        gold_pairwise = torch.bincount((tags[:, :-1] * num_tags + tags[:, 1:]).reshape(-1),
+                                       weights = mask[:, 1:].reshape(-1), minlength = num_tags * num_tags)
+        grad_transitions = gold_pairwise.view(num_tags, num_tags).to(logits.dtype) - pairwise.sum((0, 1))
+
+        grad_start = gold_unary[:, 0].sum(0) - unary[:, 0].sum(0)
+        last_index = last_tag_index.view(batch_size, 1, 1).expand(batch_size, 1, num_tags)
+        grad_end = (gold_unary.gather(1, last_index) - unary.gather(1, last_index)).sum((0, 1))
+        return grad_logits * grad_output, None, None, grad_transitions * grad_output, \
+               grad_start * grad_output, grad_end * grad_output, None
+
+def semiring_matmul(a, b, semiring = 'log'):
+    '''
+    matrix product in the log semiring (logsumexp, +) or the max semiring (max, +)
+    a: (..., n, m)
+    b: (..., m, p)
+    output: (..., n, p)
+    '''
+    inner = a.unsqueeze(-1) + b.unsqueeze(-3)
+    if semiring == 'log':
+        return logsumexp(inner, -2)
+    return inner.max(-2).values
+
+def semiring_scan(matrices, semiring = 'log'):
+    '''
+    inclusive prefix products with O(log n) sequential depth (Hillis-Steele scan)
+    matrices: (batch_size, n, num_tags, num_tags)
+    output: (batch_size, n, num_tags, num_tags), output[:, i] = matrices[:, 0] x ... x matrices[:, i]
+    '''
+    n = matrices.size(1)
+    offset = 1
+    while offset < n:
+        combined = semiring_matmul(matrices[:, :-offset], matrices[:, offset:], semiring)
+        matrices = torch.cat([matrices[:, :offset], combined], dim = 1)
+        offset *= 2
+    return matrices
+
+def scan_forward_backward(logits, mask, transitions, start_transitions, end_transitions, semiring = 'log'):
+    '''
+    forward-backward algorithm with parallel scans over the timestep potentials
+    memory is O(batch_size * sen_len * num_tags^3)
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+        semiring: 'log' for sums over paths, 'max' for best paths
+    output:
+        alpha: (batch_size, sen_len, num_tags)
+        beta: (batch_size, sen_len, num_tags)
+    '''
+    batch_size, sequence_length, num_tags = logits.size()
+    mask = mask.bool()
+    alpha = logits[:, 0] + start_transitions.view(1, num_tags)
+    end_beta = end_transitions.view(1, 1, num_tags).expand(batch_size, 1, num_tags)
+    if sequence_length == 1:
+        return alpha.unsqueeze(1), end_beta
+    # matrices[:, i - 1]: (from_tag, to_tag) potentials of timestep i, padded timesteps are identity
+    identity = torch.full((num_tags, num_tags), -10000., device = logits.device)
+    identity.fill_diagonal_(0.)
+    matrices = transitions.view(1, 1, num_tags, num_tags) + logits[:, 1:].unsqueeze(2)
+    matrices = torch.where(mask[:, 1:].view(batch_size, -1, 1, 1), matrices, identity)
+
+    # prefix[:, i - 1] = step 1 x ... x step i
+    prefix = semiring_scan(matrices, semiring)
+    alphas = semiring_matmul(alpha.view(batch_size, 1, 1, num_tags), prefix, semiring).squeeze(2)
+    alphas = torch.cat([alpha.unsqueeze(1), alphas], dim = 1)
+    # suffix[:, i] = step i + 1 x ... x step sen_len - 1, computed as a prefix scan of reversed transposed steps
+    suffix = semiring_scan(matrices.flip(1).transpose(2, 3), semiring).flip(1).transpose(2, 3)
+    betas = semiring_matmul(suffix, end_transitions.view(1, 1, num_tags, 1), semiring).squeeze(3)
+    betas = torch.cat([betas, end_beta], dim = 1)
+    return alphas, betas
+
+def observe_tags(logits, tag_observations):
+    '''
+    force the observed tags by giving every other tag an emission score of -10000
+    logits: (batch_size, sen_len, num_tags)
+    tag_observations: (batch_size, sen_len), observed tag of each token, -1 for unobserved tokens
+    '''
+    num_tags = logits.size(2)
+    tag_observations = tag_observations.unsqueeze(2)
+    allowed = (tag_observations == -1) | (tag_observations == torch.arange(num_tags, device = logits.device).view(1, 1, num_tags))
+    return logits.masked_fill(~allowed, -10000.)
+
 def is_transition_allowed(from_tag, from_entity, to_tag, to_entity):
     '''
     transition rules of BIOES tagging scheme
@@ -95,6 +377,254 @@ def allowed_transitions(tag_dict):
                 allowed.append((from_label_index, to_label_index))
     return allowed
 
+def bioes_structure(tag_dict, num_tags):
+    '''
+    index tensors of the block structure of BIOES transitions
+    tag_dict: index to label dict
+    output:
+        closed_tags: O, E-*, S-*, the only tags that can precede O, B-*, S-*
+        open_tags: O, B-*, S-*
+        begin_tags & inside_tags & end_tags: B-t, I-t, E-t of each type t, aligned by type
+    '''
+    labels = {tag_dict[i]: i for i in range(num_tags)}
+    types = [label[2:] for label in labels if label.startswith('B-')]
+    for pos in ['I', 'E', 'S']:
+        for entity in types:
+            if pos + '-' + entity not in labels:
+                raise ValueError('Tag {}-{} is missing, the tags are not a BIOES tag set.'.format(pos, entity))
+    if 'O' not in labels:
+        raise ValueError('Tag O is missing, the tags are not a BIOES tag set.')
+    index = lambda pos: [labels[pos + '-' + entity] for entity in types]
+    closed_tags = torch.tensor([labels['O']] + index('E') + index('S'), dtype = torch.long)
+    open_tags = torch.tensor([labels['O']] + index('B') + index('S'), dtype = torch.long)
+    begin_tags = torch.tensor(index('B'), dtype = torch.long)
+    inside_tags = torch.tensor(index('I'), dtype = torch.long)
+    end_tags = torch.tensor(index('E'), dtype = torch.long)
+    return closed_tags, open_tags, begin_tags, inside_tags, end_tags
+
+def sparse_forward(logits, mask, transitions, start_transitions, end_transitions, structure, semiring = 'log'):
+    '''
+    alpha recursion that only visits the transitions allowed by BIOES
+    with semiring 'log' this is the partition over BIOES-valid paths only, the one of a dense lattice with -inf
+    for forbidden transitions, the loop, scan and fused engines sum over all paths with the learned transitions,
+    so the sparse loss is a different objective and its values are not comparable with theirs
+    per timestep cost with N entity types is (2N + 1)^2 for the O/E/S -> O/B/S block plus 4N for B/I -> I/E,
+    instead of (4N + 1)^2: still quadratic in N, a constant factor (about 4x) less than the dense recursion
+    tags outside the structure (e.g. <PAD>) are unreachable
+    input:
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+        structure: output of bioes_structure
+        semiring: 'log' for sums over paths, 'max' for best paths
+    output:
+        alpha: (batch_size, num_tags), alpha of the last token
+        backpointers: list of (batch_size, num_tags), empty for semiring 'log'
+    '''
+    closed_tags, open_tags, begin_tags, inside_tags, end_tags = structure
+    batch_size, sequence_length, num_tags = logits.size()
+    mask = mask.bool()
+    identity = torch.arange(num_tags, device = logits.device).view(1, num_tags).expand(batch_size, num_tags)
+    # boundary: (closed_tag, open_tag)
+    boundary = transitions[closed_tags][:, open_tags]
+    # into_inside & into_end: (num_types, 2), transitions from B-t and I-t
+    into_inside = torch.stack([transitions[begin_tags, inside_tags], transitions[inside_tags, inside_tags]], dim = 1)
+    into_end = torch.stack([transitions[begin_tags, end_tags], transitions[inside_tags, end_tags]], dim = 1)
+    # from_entity: (2, num_types), B-t and I-t
+    from_entity = torch.stack([begin_tags, inside_tags], dim = 0)
+
+    alpha = logits[:, 0] + start_transitions.view(1, num_tags)
+    backpointers = []
+    for i in range(1, sequence_length):
+        # inner: (batch_size, closed_tag, open_tag)
+        inner = alpha[:, closed_tags].unsqueeze(2) + boundary.unsqueeze(0)
+        # entity: (batch_size, num_types, 2)
+        entity = torch.stack([alpha[:, begin_tags], alpha[:, inside_tags]], dim = 2)
+        next_alpha = alpha.new_full((batch_size, num_tags), -10000.)
+        if semiring == 'log':
+            next_alpha[:, open_tags] = logsumexp(inner, 1)
+            next_alpha[:, inside_tags] = logsumexp(entity + into_inside, 2)
+            next_alpha[:, end_tags] = logsumexp(entity + into_end, 2)
+        else:
+            backpointer = identity.clone()
+            score, best = inner.max(1)
+            next_alpha[:, open_tags] = score
+            backpointer[:, open_tags] = closed_tags[best]
+            score, best = (entity + into_inside).max(2)
+            next_alpha[:, inside_tags] = score
+            backpointer[:, inside_tags] = from_entity.gather(0, best)
+            score, best = (entity + into_end).max(2)
+            next_alpha[:, end_tags] = score
+            backpointer[:, end_tags] = from_entity.gather(0, best)
+            backpointers.append(torch.where(mask[:, i].unsqueeze(1), backpointer, identity))
+        # if mask == 0, then keep alpha unchanged
+        alpha = torch.where(mask[:, i].unsqueeze(1), next_alpha + logits[:, i], alpha)
+    return alpha, backpointers
+
+def packed_index(batch_sizes, device = None):
+    '''
+    batch_sizes: (sen_len), PackedSequence.batch_sizes
+    output:
+        time_index & seq_index: (num_tokens), timestep and (sorted) sequence of each packed token
+    '''
+    batch_sizes = batch_sizes.to(device)
+    time_index = torch.repeat_interleave(torch.arange(batch_sizes.size(0), device = device), batch_sizes)
+    offsets = torch.cumsum(batch_sizes, 0) - batch_sizes
+    seq_index = torch.arange(time_index.size(0), device = device) - offsets[time_index]
+    return time_index, seq_index
+
+def packed_log_partition(emissions, batch_sizes, transitions, start_transitions, end_transitions):
+    '''
+    forward algorithm on a packed batch, each timestep only visits the sequences that are still running
+    input:
+        emissions: (num_tokens, num_tags), PackedSequence.data
+        batch_sizes: (sen_len), PackedSequence.batch_sizes
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+    output:
+        log_partition: (batch_size), in the sorted order of the PackedSequence
+    '''
+    batch_sizes = batch_sizes.tolist()
+    alpha = emissions[: batch_sizes[0]] + start_transitions.view(1, -1)
+    finished = [] # alphas of the sequences that already ended, the shortest first
+    offset = batch_sizes[0]
+    for batch_size in batch_sizes[1:]:
+        if batch_size < alpha.size(0):
+            finished.append(alpha[batch_size:])
+            alpha = alpha[: batch_size]
+        inner = alpha.unsqueeze(2) + transitions.unsqueeze(0)
+        alpha = logsumexp(inner, 1) + emissions[offset: offset + batch_size]
+        offset += batch_size
+    alpha = torch.cat([alpha] + finished[::-1])
+    return logsumexp(alpha + end_transitions.view(1, -1))
+
+def packed_path_score(emissions, tags, batch_sizes, transitions, start_transitions, end_transitions):
+    '''
+    score of the given tag paths on a packed batch
+    input:
+        emissions: (num_tokens, num_tags), PackedSequence.data
+        tags: (num_tokens), packed in the same order as emissions
+        batch_sizes: (sen_len), PackedSequence.batch_sizes
+    output:
+        score: (batch_size), in the sorted order of the PackedSequence
+    '''
+    num_tokens = tags.size(0)
+    time_index, seq_index = packed_index(batch_sizes, emissions.device)
+    batch_sizes = batch_sizes.to(emissions.device)
+    score = emissions.gather(1, tags.unsqueeze(1)).squeeze(1)
+    # the previous token of the same sequence is batch_sizes[t - 1] tokens before
+    later = time_index > 0
+    position = torch.arange(num_tokens, device = emissions.device)
+    previous = position[later] - batch_sizes[time_index[later] - 1]
+    transition_score = start_transitions[tags]
+    transition_score[later] = transitions[tags[previous], tags[later]]
+    # a token is the last one of its sequence if the sequence is not running at the next timestep
+    next_sizes = torch.cat([batch_sizes[1:], batch_sizes.new_zeros(1)])
+    end_score = torch.where(seq_index >= next_sizes[time_index], end_transitions[tags], torch.zeros_like(score))
+    return torch.zeros(batch_sizes[0].item(), dtype = score.dtype, device = score.device) \
+        .index_add(0, seq_index, score + transition_score + end_score)
+
+def packed_viterbi_decode(emissions, batch_sizes, transitions, start_transitions, end_transitions):
+    '''
+    viterbi decoding on a packed batch, each timestep only visits the sequences that are still running
+    input:
+        emissions: (num_tokens, num_tags), PackedSequence.data
+        batch_sizes: (sen_len), PackedSequence.batch_sizes
+    output:
+        best_paths: (num_tokens), packed in the same order as emissions
+        best_scores: (batch_size), in the sorted order of the PackedSequence
+    '''
+    batch_sizes = batch_sizes.tolist()
+    score = emissions[: batch_sizes[0]] + start_transitions.view(1, -1)
+    finished = []
+    backpointers = [] # backpointers[i]: (batch_sizes[i + 1], num_tags)
+    offset = batch_sizes[0]
+    for batch_size in batch_sizes[1:]:
+        if batch_size < score.size(0):
+            finished.append(score[batch_size:])
+            score = score[: batch_size]
+        inner = score.unsqueeze(2) + transitions.unsqueeze(0)
+        score, best_tag = inner.max(1)
+        score = score + emissions[offset: offset + batch_size]
+        backpointers.append(best_tag)
+        offset += batch_size
+    score = torch.cat([score] + finished[::-1]) + end_transitions.view(1, -1)
+    best_scores, best_tag = score.max(1)
+
+    # sequences that end at timestep t start backtracking from their best last tag
+    best_paths = torch.empty(emissions.size(0), dtype = torch.long, device = emissions.device)
+    offset = emissions.size(0)
+    for i in range(len(batch_sizes) - 1, -1, -1):
+        if i < len(batch_sizes) - 1:
+            running = backpointers[i].size(0)
+            previous = backpointers[i].gather(1, best_tag[: running].unsqueeze(1)).squeeze(1)
+            best_tag = torch.cat([previous, best_tag[running:]])
+        offset -= batch_sizes[i]
+        best_paths[offset: offset + batch_sizes[i]] = best_tag[: batch_sizes[i]]
+    return best_paths, best_scores
+
+
+class FixedLagViterbi():
+    '''
+    online viterbi decoding for a single unbounded sequence
+    the tag of a token is committed once lag more tokens are seen, hypotheses that disagree with committed tags are pruned
+    memory is O(lag * num_tags) for any sequence length
+    '''
+    def __init__(self, crf, lag = 16):
+        self.transitions, self.start_transitions, self.end_transitions = crf._constrained_transitions()
+        self.num_tags = crf.num_tags
+        self.lag = lag
+        self.score = None # (num_tags)
+        self.backpointers = deque() # backpointers of the uncommitted tokens
+
+    def _commit(self):
+        # ancestor: (num_tags), tag of the oldest uncommitted token on the best path to each current tag
+        ancestor = torch.arange(self.num_tags, device = self.score.device)
+        for backpointer in reversed(self.backpointers):
+            ancestor = backpointer[ancestor]
+        tag = ancestor[self.score.argmax()]
+        self.score = self.score.masked_fill(ancestor != tag, float('-inf'))
+        self.backpointers.popleft()
+        return tag.item()
+
+    def step(self, emissions):
+        '''
+        emissions: (n, num_tags), emission scores of the next n tokens
+        output:
+            tags: list, tags committed by these tokens
+        '''
+        tags = []
+        for emission in emissions.detach().view(-1, self.num_tags):
+            if self.score is None:
+                self.score = emission + self.start_transitions
+                continue
+            inner = self.score.unsqueeze(1) + self.transitions
+            best_score, best_tag = inner.max(0)
+            self.score = best_score + emission
+            self.backpointers.append(best_tag)
+            if len(self.backpointers) > self.lag:
+                tags.append(self._commit())
+        return tags
+
+    def flush(self):
+        '''
+        end the sequence
+        output:
+            tags: list, tags of all uncommitted tokens
+        '''
+        if self.score is None:
+            return []
+        best_tag = (self.score + self.end_transitions).argmax()
+        tags = [best_tag.item()]
+        for backpointer in reversed(self.backpointers):
+            best_tag = backpointer[best_tag]
+            tags.append(best_tag.item())
+        tags.reverse()
+        self.score = None
+        self.backpointers.clear()
+        return tags
+
 # mostly come from allennlp ConditionalRandomField
 class CRF(nn.Module):
     def __init__(self, tag_dict):
@@ -109,6 +639,7 @@ class CRF(nn.Module):
         for i, j in constraint:
             constraint_mask[i, j] = 1.
         self._constraint_mask = torch.nn.Parameter(constraint_mask, requires_grad=False)
+        self._structure = None
         self.start_transitions = nn.Parameter(torch.Tensor(self.num_tags))
         self.end_transitions = nn.Parameter(torch.Tensor(self.num_tags))
         # init params
@@ -116,12 +647,30 @@ class CRF(nn.Module):
         nn.init.normal_(self.start_transitions)
         nn.init.normal_(self.end_transitions)
 
-    def _input_likelihood(self, logits, mask):
+    def _fit_width(self, logits, *tensors):
+        '''
+        cut masks and tags that are wider than logits, e.g. of a batch padded past its longest sentence,
+        to the sen_len of logits, the columns beyond it are padding
+        '''
+        sequence_length = logits.size(1)
+        return [None if tensor is None else tensor[:, : sequence_length] for tensor in tensors]
+
+    def _input_likelihood(self, logits, mask, engine = 'loop'):
         '''
         logits: (batch_size, sen_len, num_tags)
         mask: (batch_size, sen_len), means whether the token is padded
+        engine: 'loop' walks the timesteps, 'scan' uses parallel prefix scans,
+                'sparse' only visits BIOES transitions, so forbidden paths are excluded from the partition,
+                a different objective than the other engines, see sparse_forward
         '''
         batch_size, sequence_length, num_tags = logits.size()
+        if engine == 'scan':
+            alpha, _ = scan_forward_backward(logits, mask, self.transitions, self.start_transitions, self.end_transitions)
+            return logsumexp(alpha[:, -1] + self.end_transitions.view(1, num_tags))
+        if engine == 'sparse':
+            transitions, start_transitions, end_transitions = self._constrained_transitions(detach = False)
+            alpha, _ = sparse_forward(logits, mask, transitions, start_transitions, end_transitions, self._bioes_structure(logits.device))
+            return logsumexp(alpha + end_transitions.view(1, num_tags))
         # mask: (sen_len, batch_size)
         mask = mask.float().transpose(0, 1).contiguous()
         # logits: (sen_len, batch_size, num_tags)
@@ -145,80 +694,274 @@ class CRF(nn.Module):
         tags: (batch_size, sen_len)
         mask: (batch_size, sen_len), means whether the token is padded
         '''
-        batch_size, sequence_length, _ = logits.data.shape
-        # logits: (sen_len, batch_size, num_tags)
-        logits = logits.transpose(0, 1).contiguous()
-        # mask: (sen_len, batch_size)
-        mask = mask.float().transpose(0, 1).contiguous()
-        # tags: (sen_len, batch_size)
-        tags = tags.transpose(0, 1).contiguous()
-        score = self.start_transitions.index_select(0, tags[0])
-        for i in range(sequence_length-1):
-            current_tag, next_tag = tags[i], tags[i + 1]
-            transition_score = self.transitions[current_tag.view(-1), next_tag.view(-1)]
-            emit_score = logits[i].gather(1, current_tag.view(batch_size, 1)).squeeze(1)
-            score = score + transition_score * mask[i + 1] + emit_score * mask[i]
-        last_tag_index = mask.sum(0).long() - 1
-        last_tags = tags.gather(0, last_tag_index.view(1, batch_size)).squeeze(0)
-        last_transition_score = self.end_transitions.index_select(0, last_tags)
-        last_inputs = logits[-1]
-        last_input_score = last_inputs.gather(1, last_tags.view(-1, 1))
-        last_input_score = last_input_score.squeeze()
-        score = score + last_transition_score + last_input_score * mask[-1]
-        return score
-
-    def forward(self, inputs, tags, mask):
+        return path_score(logits, tags, mask, self.transitions, self.start_transitions, self.end_transitions)
+
+    def forward(self, inputs, tags, mask, engine = 'loop', weights = None):
         '''
         inputs: (batch_size, sen_len, num_tags)
         tags: (batch_size, sen_len)
         mask: (batch_size, sen_len)
+        engine: 'loop', 'scan', 'sparse' or 'fused' (CRFLogLikelihood)
+        weights: (batch_size), weight of each sentence in the sum, e.g. 0 for rows padding the batch, 1 if None
         '''
         if mask is None:
             mask = torch.ones(*tags.size(), dtype=torch.long)
-        log_denominator = self._input_likelihood(inputs, mask)
+        tags, mask = self._fit_width(inputs, tags, mask)
+        if engine == 'fused' and torch.is_grad_enabled():
+            return CRFLogLikelihood.apply(inputs, tags, mask, self.transitions, self.start_transitions, self.end_transitions, weights)
+        if engine == 'fused':
+            engine = 'loop' # no backward, e.g. validation under no_grad, the alpha pass is enough
+        log_denominator = self._input_likelihood(inputs, mask, engine)
         log_numerator = self._joint_likelihood(inputs, tags, mask)
+        if weights is not None:
+            return torch.sum((log_numerator - log_denominator) * weights)
         return torch.sum(log_numerator - log_denominator)
 
-    def viterbi_tags(self, logits, mask):
-        _, max_seq_length, num_tags = logits.size()
-        # Get the tensors out of the variables
-        logits, mask = logits.data, mask.data
+    def forward_packed(self, emissions, tags):
+        '''
+        log likelihood of a packed batch, no computation is spent on padding
+        emissions: PackedSequence of (num_tokens, num_tags)
+        tags: (batch_size, sen_len)
+        '''
+        time_index, seq_index = packed_index(emissions.batch_sizes, tags.device)
+        if emissions.sorted_indices is not None:
+            seq_index = emissions.sorted_indices[seq_index]
+        tags = tags[seq_index, time_index]
+        log_denominator = packed_log_partition(emissions.data, emissions.batch_sizes,
+                                               self.transitions, self.start_transitions, self.end_transitions)
+        log_numerator = packed_path_score(emissions.data, tags, emissions.batch_sizes,
+                                          self.transitions, self.start_transitions, self.end_transitions)
+        return torch.sum(log_numerator - log_denominator)
+
+    def _constrained_transitions(self, detach = True, forbidden = -10000.):
+        '''
+        transition scores with BIOES constraints, forbidden transitions are set to forbidden
+        forbidden: -10000 keeps every path finite, -inf removes the forbidden paths from the lattice
+        output:
+            transitions: (num_tags, num_tags)
+            start_transitions & end_transitions: (num_tags)
+        '''
+        num_tags = self.num_tags
         start_tag = num_tags
         end_tag = num_tags + 1
-        transitions = torch.Tensor(num_tags + 2, num_tags + 2).fill_(-10000.)
-        # Apply transition constraints
-        constrained_transitions = (
-                self.transitions * self._constraint_mask[:num_tags, :num_tags] +
-                -10000.0 * (1 - self._constraint_mask[:num_tags, :num_tags])
-        )
-        transitions[:num_tags, :num_tags] = constrained_transitions.data
-        transitions[start_tag, :num_tags] = (self.start_transitions.detach() * self._constraint_mask[start_tag, :num_tags].data \
-            + -10000. * (1 - self._constraint_mask[start_tag, :num_tags].detach()))
-        transitions[:num_tags, end_tag] = (self.end_transitions.detach() * self._constraint_mask[:num_tags, end_tag].data \
-            + -10000. * (1 - self._constraint_mask[:num_tags, end_tag].detach()))
-        best_paths = []
-        # Pad the max sequence length by 2 to account for start_tag + end_tag.
-        tag_sequence = torch.Tensor(max_seq_length + 2, num_tags + 2)
-
-        for prediction, prediction_mask in zip(logits, mask):
-            sequence_length = torch.sum(prediction_mask)
-            # Start with everything totally unlikely
-            tag_sequence.fill_(-10000.)
-            # At timestep 0 we must have the START_TAG
-            tag_sequence[0, start_tag] = 0.
-            # At steps 1, ..., sequence_length we just use the incoming prediction
-            tag_sequence[1:(sequence_length + 1), :num_tags] = prediction[:sequence_length]
-            # And at the last timestep we must have the END_TAG
-            tag_sequence[sequence_length + 1, end_tag] = 0.
-            # We pass the tags and the transitions to ``viterbi_decode``.
-            viterbi_path, viterbi_score = viterbi_decode(tag_sequence[:(sequence_length + 2)], transitions)
-            # Get rid of START and END sentinels and append.
-            viterbi_path = viterbi_path[1:-1]
-            best_paths.append((viterbi_path, viterbi_score.item()))
-        
-        predicted_tags = [x for x, y in best_paths]
-        predicted_tensor = mask * 0.
-        for i, instance_tags in enumerate(predicted_tags):
-            for j, tag_id in enumerate(instance_tags):
-                predicted_tensor[i, j] = tag_id
-        return predicted_tensor.long()
+        constraint_mask = self._constraint_mask.detach().bool()
+        transitions, start_transitions, end_transitions = self.transitions, self.start_transitions, self.end_transitions
+        if detach:
+            transitions, start_transitions, end_transitions = transitions.detach(), start_transitions.detach(), end_transitions.detach()
+        transitions = transitions.masked_fill(~constraint_mask[:num_tags, :num_tags], forbidden)
+        start_transitions = start_transitions.masked_fill(~constraint_mask[start_tag, :num_tags], forbidden)
+        end_transitions = end_transitions.masked_fill(~constraint_mask[:num_tags, end_tag], forbidden)
+        return transitions, start_transitions, end_transitions
+
+    def _bioes_structure(self, device):
+        if self._structure is None or self._structure[0].device != device:
+            self._structure = [index.to(device) for index in bioes_structure(self.tag_dict, self.num_tags)]
+        return self._structure
+
+    def viterbi_tags(self, logits, mask, engine = 'loop', tag_observations = None):
+        '''
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        engine: 'scan' takes the argmax of max-marginals from parallel scans,
+                'sparse' only visits BIOES transitions, otherwise walks the timesteps
+        tag_observations: (batch_size, sen_len), tags the path must go through, -1 for free tokens
+        output:
+            predict: (batch_size, sen_len), at the width of mask if mask is wider than logits
+        '''
+        if mask.size(1) > logits.size(1):
+            predict = self.viterbi_tags(logits, *self._fit_width(logits, mask), engine, *self._fit_width(logits, tag_observations))
+            padding = predict.new_zeros(mask.size(0), mask.size(1) - logits.size(1))
+            return torch.cat([predict, padding], dim = 1)
+        transitions, start_transitions, end_transitions = self._constrained_transitions()
+        logits = logits.detach()
+        if tag_observations is not None:
+            logits = observe_tags(logits, tag_observations)
+        if engine == 'scan':
+            alpha, beta = scan_forward_backward(logits, mask, transitions, start_transitions, end_transitions, 'max')
+            # ties between best paths are broken per token
+            return (alpha + beta).argmax(2) * mask.long()
+        if engine == 'sparse':
+            alpha, backpointers = sparse_forward(logits, mask, transitions, start_transitions, end_transitions,
+                                                 self._bioes_structure(logits.device), 'max')
+            best_tag = (alpha + end_transitions.view(1, -1)).argmax(1)
+            return backtrack(backpointers, best_tag, mask)
+        best_paths, _ = viterbi_decode_batch(logits, mask, transitions, start_transitions, end_transitions)
+        return best_paths
+
+    def viterbi_tags_packed(self, emissions):
+        '''
+        emissions: PackedSequence of (num_tokens, num_tags)
+        output:
+            predict: (batch_size, sen_len), padded tokens are 0
+        '''
+        transitions, start_transitions, end_transitions = self._constrained_transitions()
+        best_paths, _ = packed_viterbi_decode(emissions.data.detach(), emissions.batch_sizes,
+                                              transitions, start_transitions, end_transitions)
+        best_paths = PackedSequence(best_paths, emissions.batch_sizes, emissions.sorted_indices, emissions.unsorted_indices)
+        predict, _ = pad_packed_sequence(best_paths, batch_first = True)
+        return predict
+
+    def gated_viterbi_tags(self, logits, mask, margin = None, engine = 'loop'):
+        '''
+        take the emission argmax path of a sentence if it is allowed by BIOES and every token has a clear margin,
+        only the other sentences are decoded by viterbi_tags
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        margin: min gap between the best and the second best emission of every token
+                None uses 2 * (max - min) of the allowed transition scores, then the argmax path is the viterbi path
+        output:
+            predict: (batch_size, sen_len), at the width of mask if mask is wider than logits
+            fast: (batch_size), whether each sentence took the argmax path
+        '''
+        if mask.size(1) > logits.size(1):
+            predict, fast = self.gated_viterbi_tags(logits, *self._fit_width(logits, mask), margin, engine)
+            padding = predict.new_zeros(mask.size(0), mask.size(1) - logits.size(1))
+            return torch.cat([predict, padding], dim = 1), fast
+        logits = logits.detach()
+        mask = mask.bool()
+        num_tags = self.num_tags
+        start_tag = num_tags
+        end_tag = num_tags + 1
+        constraint_mask = self._constraint_mask.detach().bool()
+        if margin is None:
+            allowed_scores = torch.cat([self.transitions.detach()[constraint_mask[:num_tags, :num_tags]],
+                                        self.start_transitions.detach()[constraint_mask[start_tag, :num_tags]],
+                                        self.end_transitions.detach()[constraint_mask[:num_tags, end_tag]]])
+            margin = 2 * (allowed_scores.max() - allowed_scores.min())
+
+        top = logits.topk(2, dim = 2).values
+        argmax = logits.argmax(2)
+        clear = (top[:, :, 0] - top[:, :, 1] > margin) | ~mask
+        allowed = constraint_mask[argmax[:, :-1], argmax[:, 1:]] | ~mask[:, 1:]
+        last_tags = argmax.gather(1, (mask.sum(1) - 1).unsqueeze(1)).squeeze(1)
+        fast = clear.all(1) & allowed.all(1) & constraint_mask[start_tag, argmax[:, 0]] & constraint_mask[last_tags, end_tag]
+
+        predict = argmax * mask.long()
+        slow = (~fast).nonzero().squeeze(1)
+        if slow.size(0) > 0:
+            slow_len = mask[slow].sum(1).max().item()
+            predict[slow, :slow_len] = self.viterbi_tags(logits[slow, :slow_len], mask[slow, :slow_len], engine)
+        return predict, fast
+
+    def viterbi_topk(self, logits, mask, k):
+        '''
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        k: number of paths for each sentence
+        output:
+            predict: (batch_size, k, sen_len), -1 for the ranks of a sentence with less than k BIOES-valid paths
+            scores: (batch_size, k), -inf for these ranks
+        '''
+        # forbidden transitions are removed from the lattice, a finite penalty would rank invalid paths after the valid ones
+        transitions, start_transitions, end_transitions = self._constrained_transitions(forbidden = float('-inf'))
+        return viterbi_topk_batch(logits.detach(), mask, transitions, start_transitions, end_transitions, k)
+
+    def _entity_tags(self, device):
+        '''
+        output:
+            is_begin: (num_tags), whether a tag starts an entity (B-, S-)
+            is_end: (num_tags), whether a tag ends an entity (E-, S-)
+        '''
+        labels = [self.tag_dict[i] for i in range(self.num_tags)]
+        is_begin = torch.tensor([label[:2] in ['B-', 'S-'] for label in labels], dtype = torch.bool, device = device)
+        is_end = torch.tensor([label[:2] in ['E-', 'S-'] for label in labels], dtype = torch.bool, device = device)
+        return is_begin, is_end
+
+    def marginals(self, logits, mask, pairwise = False):
+        '''
+        tag marginals under the constrained CRF used by viterbi_tags
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        pairwise: also return the marginals of adjacent tag pairs
+        output:
+            marginals: (batch_size, sen_len, num_tags), padded tokens are 0
+            pair_marginals: (batch_size, sen_len - 1, num_tags, num_tags), if pairwise,
+                            pair_marginals[:, i] is the marginal of (tag i, tag i + 1), 0 if token i + 1 is padded
+        '''
+        logits = logits.detach()
+        transitions, start_transitions, end_transitions = self._constrained_transitions()
+        alpha, beta, log_partition = forward_backward(logits, mask, transitions, start_transitions, end_transitions)
+        marginals = (alpha + beta - log_partition.view(-1, 1, 1)).exp()
+        marginals = marginals * mask.float().unsqueeze(2)
+        if not pairwise:
+            return marginals
+        pair_marginals = (alpha[:, :-1].unsqueeze(3) + transitions.view(1, 1, self.num_tags, self.num_tags) + \
+                          (logits[:, 1:] + beta[:, 1:]).unsqueeze(2) - log_partition.view(-1, 1, 1, 1)).exp()
+        return marginals, pair_marginals * mask[:, 1:].float().view(mask.size(0), -1, 1, 1)
+
+    def soft_likelihood(self, inputs, mask, marginals, pair_marginals, engine = 'loop'):
+        '''
+        expected log likelihood of the tag distribution given by marginals, e.g. of a teacher CRF,
+        the negative cross entropy between that distribution and this CRF
+        inputs: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len)
+        marginals & pair_marginals: output of CRF.marginals with pairwise = True
+        engine: 'loop', 'scan' or 'sparse', see _input_likelihood, 'fused' falls back to 'loop'
+        '''
+        batch_size = inputs.size(0)
+        last = mask.long().sum(1) - 1
+        expected_score = torch.sum(marginals * inputs) + \
+                         torch.sum(pair_marginals * self.transitions.view(1, 1, self.num_tags, self.num_tags)) + \
+                         torch.sum(marginals[:, 0] * self.start_transitions.view(1, -1)) + \
+                         torch.sum(marginals[torch.arange(batch_size, device = inputs.device), last] * self.end_transitions.view(1, -1))
+        if engine == 'fused':
+            engine = 'loop'
+        log_denominator = self._input_likelihood(inputs, mask, engine)
+        return expected_score - torch.sum(log_denominator)
+
+    def entity_confidence(self, logits, mask, tags):
+        '''
+        probability that each entity in tags is labeled with exactly this span and type
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        tags: (batch_size, sen_len), e.g. output of viterbi_tags
+        output:
+            confidence: (batch_size, sen_len), confidence of the entity starting at each token, 0 elsewhere
+        '''
+        logits = logits.detach()
+        batch_size, sequence_length, num_tags = logits.size()
+        mask = mask.bool()
+        transitions, start_transitions, end_transitions = self._constrained_transitions()
+        alpha, beta, log_partition = forward_backward(logits, mask, transitions, start_transitions, end_transitions)
+
+        is_begin, is_end = self._entity_tags(logits.device)
+        begin = is_begin[tags] & mask
+        # span_end: (batch_size, sen_len), the nearest entity end at or after each token
+        last = torch.arange(sequence_length, device = logits.device).view(1, -1) == (mask.sum(1, keepdim = True) - 1)
+        index = torch.arange(sequence_length, device = logits.device).view(1, -1).expand(batch_size, -1)
+        index = torch.where((is_end[tags] & mask) | last, index, torch.full_like(index, sequence_length - 1))
+        span_end = torch.flip(torch.cummin(torch.flip(index, [1]), 1).values, [1])
+
+        # scores of the tagged path, transition_score[:, i] is the transition into token i
+        emit_score = logits.gather(2, tags.unsqueeze(2)).squeeze(2)
+        transition_score = torch.zeros_like(emit_score)
+        transition_score[:, 1:] = transitions[tags[:, :-1], tags[:, 1:]]
+        emit_sum = emit_score.cumsum(1)
+        transition_sum = transition_score.cumsum(1)
+        span_score = (emit_sum.gather(1, span_end) - emit_sum + emit_score) + \
+                     (transition_sum.gather(1, span_end) - transition_sum)
+
+        # enter_score: all prefixes before the span, exit_score: all suffixes after the span
+        enter_score = torch.zeros_like(emit_score)
+        enter_score[:, 0] = start_transitions[tags[:, 0]]
+        if sequence_length > 1:
+            enter_score[:, 1:] = logsumexp(alpha[:, :-1] + transitions.t()[tags[:, 1:]], 2)
+        exit_score = beta.gather(2, tags.unsqueeze(2)).squeeze(2).gather(1, span_end)
+
+        confidence = (enter_score + span_score + exit_score - log_partition.view(-1, 1)).exp()
+        return confidence * begin.float()
+
+    def export_decoder(self, path = None):
+        '''
+        freeze the constrained transitions into a torch-free decoder
+        path: save the decoder to path (.npz) if given
+        output:
+            decoder: NumpyCRFDecoder
+        '''
+        transitions, start_transitions, end_transitions = self._constrained_transitions()
+        tag_dict = {i: self.tag_dict[i] for i in range(self.num_tags)}
+        decoder = NumpyCRFDecoder(transitions.cpu().numpy(), start_transitions.cpu().numpy(),
+                                  end_transitions.cpu().numpy(), tag_dict)
+        if path is not None:
+            decoder.save(path)
+        return decoder
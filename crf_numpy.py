@@ -0,0 +1,63 @@
+import numpy as np
+
+class NumpyCRFDecoder():
+    '''
+    torch-free batched viterbi decoder, frozen from a trained crf.CRF by CRF.export_decoder
+    transitions are already constrained by the BIOES rules
+    '''
+    def __init__(self, transitions, start_transitions, end_transitions, tag_dict):
+        '''
+        transitions: (num_tags, num_tags)
+        start_transitions & end_transitions: (num_tags)
+        tag_dict: index to label dict, without START and END
+        '''
+        self.transitions = np.asarray(transitions, dtype = np.float32)
+        self.start_transitions = np.asarray(start_transitions, dtype = np.float32)
+        self.end_transitions = np.asarray(end_transitions, dtype = np.float32)
+        self.tag_dict = tag_dict
+        self.num_tags = self.transitions.shape[0]
+
+    def viterbi_tags(self, logits, mask):
+        '''
+        logits: (batch_size, sen_len, num_tags)
+        mask: (batch_size, sen_len), means whether the token is padded
+        output:
+            predict: (batch_size, sen_len), padded tokens are 0
+        '''
+        logits = np.asarray(logits, dtype = np.float32)
+        mask = np.asarray(mask).astype(bool)
+        batch_size, sequence_length, num_tags = logits.shape
+        identity = np.broadcast_to(np.arange(num_tags), (batch_size, num_tags))
+        # score: (batch_size, num_tags)
+        score = logits[:, 0] + self.start_transitions[None, :]
+        backpointers = []
+        for i in range(1, sequence_length):
+            # inner: (batch_size, from_tag, to_tag)
+            inner = score[:, :, None] + self.transitions[None, :, :]
+            best_tag = inner.argmax(1)
+            best_score = np.take_along_axis(inner, best_tag[:, None, :], 1)[:, 0]
+            step_mask = mask[:, i, None]
+            score = np.where(step_mask, best_score + logits[:, i], score)
+            backpointers.append(np.where(step_mask, best_tag, identity))
+        score = score + self.end_transitions[None, :]
+        best_tag = score.argmax(1)
+
+        # Construct the most likely sequences backwards.
+        predict = np.zeros((batch_size, sequence_length), dtype = np.int64)
+        predict[:, sequence_length - 1] = best_tag
+        for i in range(sequence_length - 2, -1, -1):
+            best_tag = np.take_along_axis(backpointers[i], best_tag[:, None], 1)[:, 0]
+            predict[:, i] = best_tag
+        return predict * mask
+
+    def save(self, path):
+        tag_ids = np.array(sorted(self.tag_dict.keys()), dtype = np.int64)
+        tag_labels = np.array([self.tag_dict[i] for i in tag_ids])
+        np.savez(path, transitions = self.transitions, start_transitions = self.start_transitions,
+                 end_transitions = self.end_transitions, tag_ids = tag_ids, tag_labels = tag_labels)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        tag_dict = {int(i): str(label) for i, label in zip(data['tag_ids'], data['tag_labels'])}
+        return cls(data['transitions'], data['start_transitions'], data['end_transitions'], tag_dict)
@@ -0,0 +1,44 @@
+import torch
+
+import crf as crf_module
+from test_stream import make_tagger, random_words, full_sentence
+
+def ragged_batch(model, vocab, lengths, seed = 0):
+    '''
+    CoNLL-style inputs of sentences of the given lengths
+    '''
+    sentences = [random_words(length, seed = seed + i) for i, length in enumerate(lengths)]
+    sen_len = max(lengths)
+    inputs = [full_sentence(model, vocab, words) for words in sentences]
+    pad = lambda tensor: torch.nn.functional.pad(tensor, [0, 0] * (tensor.dim() - 2) + [0, sen_len - tensor.size(1)])
+    word_ids = torch.cat([pad(word_ids) for _, word_ids, _, _, _ in inputs])
+    word_mask = torch.cat([pad(word_mask) for _, _, word_mask, _, _ in inputs])
+    char_ids = torch.cat([pad(char_ids) for _, _, _, char_ids, _ in inputs])
+    label = torch.randint(1, model.tagset_size, word_ids.shape) * word_mask.long()
+    return sentences, word_ids, word_mask, char_ids, label
+
+def test_compiled_steps_use_crf_engine(monkeypatch):
+    calls = []
+    sparse_forward = crf_module.sparse_forward
+    def recorded_sparse_forward(*args):
+        calls.append(args[6:])
+        return sparse_forward(*args)
+    monkeypatch.setattr(crf_module, 'sparse_forward', recorded_sparse_forward)
+
+    model, vocab = make_tagger(random_words(20))
+    model.batch_size = 4
+    model.compile_bucket = 8
+    model.crf_engine = 'sparse' # its loss differs from the loop engine
+    text, word_ids, word_mask, char_ids, label = ragged_batch(model, vocab, [2, 5, 7])
+    with torch.no_grad():
+        expected = model(text, word_ids, word_mask, char_ids, None)
+    expected_loss = model(text, word_ids, word_mask, char_ids, None, label)
+    model.use_compile = True
+    calls.clear()
+    with torch.no_grad():
+        predict = model(text, word_ids, word_mask, char_ids, None)
+    # the compiled decode step is traced through the sparse engine
+    assert ('max',) in calls
+    loss = model(text, word_ids, word_mask, char_ids, None, label)
+    assert torch.equal(predict, expected)
+    assert torch.allclose(loss, expected_loss, atol = 1e-4)
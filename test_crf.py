@@ -0,0 +1,308 @@
+import itertools
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence
+
+import crf as crf_module
+from crf import CRF, CRFLogLikelihood, forward_backward, scan_forward_backward, semiring_scan, viterbi_decode
+from TagVocab import TagVocab
+
+def make_crf(type_list = ('PER', 'LOC'), seed = 0):
+    torch.manual_seed(seed)
+    tag_vocab = TagVocab(list(type_list))
+    crf = CRF({value: key for key, value in tag_vocab.tag_to_ix.items()})
+    with torch.no_grad():
+        crf.transitions.normal_()
+        crf.start_transitions.normal_()
+        crf.end_transitions.normal_()
+    return crf
+
+def random_batch(num_tags, batch_size = 5, sen_len = 4, seed = 0):
+    '''
+    ragged batch, the first sentence is full length and the others have random lengths
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(batch_size, sen_len, num_tags, generator = generator) * 3
+    lengths = torch.randint(1, sen_len + 1, (batch_size,), generator = generator)
+    lengths[0] = sen_len
+    mask = torch.arange(sen_len).view(1, -1) < lengths.view(-1, 1)
+    return logits, mask
+
+def all_path_scores(logits, length, transitions, start_transitions, end_transitions):
+    '''
+    brute force scores of every tag path of one sentence
+    output:
+        paths: (num_tags ** length, length)
+        scores: (num_tags ** length)
+    '''
+    num_tags = logits.size(1)
+    paths = torch.tensor(list(itertools.product(range(num_tags), repeat = length)), dtype = torch.long)
+    scores = start_transitions[paths[:, 0]] + end_transitions[paths[:, -1]]
+    scores = scores + logits[torch.arange(length), paths].sum(1)
+    if length > 1:
+        scores = scores + transitions[paths[:, :-1], paths[:, 1:]].sum(1)
+    return paths, scores
+
+def dense_log_partition(logits, mask, transitions, start_transitions, end_transitions):
+    '''
+    per-sentence forward algorithm with torch.logsumexp, which keeps -inf transitions finite-safe
+    '''
+    log_partition = []
+    for sentence, sentence_mask in zip(logits, mask):
+        length = int(sentence_mask.sum())
+        alpha = sentence[0] + start_transitions
+        for i in range(1, length):
+            alpha = torch.logsumexp(alpha.unsqueeze(1) + transitions, 0) + sentence[i]
+        log_partition.append(torch.logsumexp(alpha + end_transitions, 0))
+    return torch.stack(log_partition)
+
+def per_sentence_viterbi(crf, logits, mask):
+    '''
+    one viterbi_decode per sentence with START and END sentinel tags, the decoding of the original CRF.viterbi_tags
+    '''
+    num_tags = crf.num_tags
+    start_tag, end_tag = num_tags, num_tags + 1
+    constraint_mask = crf._constraint_mask.detach()
+    transitions = torch.full((num_tags + 2, num_tags + 2), -10000.)
+    transitions[:num_tags, :num_tags] = crf.transitions.detach() * constraint_mask[:num_tags, :num_tags] + \
+        -10000. * (1 - constraint_mask[:num_tags, :num_tags])
+    transitions[start_tag, :num_tags] = crf.start_transitions.detach() * constraint_mask[start_tag, :num_tags] + \
+        -10000. * (1 - constraint_mask[start_tag, :num_tags])
+    transitions[:num_tags, end_tag] = crf.end_transitions.detach() * constraint_mask[:num_tags, end_tag] + \
+        -10000. * (1 - constraint_mask[:num_tags, end_tag])
+    predict = torch.zeros(mask.shape, dtype = torch.long)
+    for i, (sentence, sentence_mask) in enumerate(zip(logits.float(), mask)):
+        length = int(sentence_mask.sum())
+        tag_sequence = torch.full((length + 2, num_tags + 2), -10000.)
+        tag_sequence[0, start_tag] = 0.
+        tag_sequence[1: length + 1, :num_tags] = sentence[:length]
+        tag_sequence[length + 1, end_tag] = 0.
+        path, _ = viterbi_decode(tag_sequence, transitions)
+        predict[i, :length] = torch.tensor(path[1: -1])
+    return predict
+
+def per_sentence_log_likelihood(logits, tags, mask, transitions, start_transitions, end_transitions):
+    '''
+    gold path score minus log partition, one sentence at a time
+    '''
+    log_partition = dense_log_partition(logits, mask, transitions, start_transitions, end_transitions)
+    log_likelihood = []
+    for sentence, sentence_tags, sentence_mask, partition in zip(logits, tags, mask, log_partition):
+        length = int(sentence_mask.sum())
+        path = sentence_tags[:length]
+        score = start_transitions[path[0]] + end_transitions[path[-1]] + sentence[torch.arange(length), path].sum()
+        score = score + transitions[path[:-1], path[1:]].sum()
+        log_likelihood.append(score - partition)
+    return torch.stack(log_likelihood)
+
+def per_sentence_marginals(logits, mask, transitions, start_transitions, end_transitions):
+    '''
+    tag and adjacent pair marginals by enumerating every path of each sentence
+    '''
+    batch_size, sen_len, num_tags = logits.size()
+    marginals = torch.zeros(batch_size, sen_len, num_tags, dtype = logits.dtype)
+    pair_marginals = torch.zeros(batch_size, sen_len - 1, num_tags, num_tags, dtype = logits.dtype)
+    for i in range(batch_size):
+        length = int(mask[i].sum())
+        paths, scores = all_path_scores(logits[i, :length], length, transitions, start_transitions, end_transitions)
+        probability = scores.softmax(0)
+        for j in range(length):
+            marginals[i, j].index_add_(0, paths[:, j], probability)
+            if j + 1 < length:
+                pair_marginals[i, j].view(-1).index_add_(0, paths[:, j] * num_tags + paths[:, j + 1], probability)
+    return marginals, pair_marginals
+
+def test_batched_viterbi_matches_per_sentence():
+    crf = make_crf(('PER', 'LOC', 'ORG'))
+    for seed in range(3):
+        logits, mask = random_batch(crf.num_tags, batch_size = 8, sen_len = 9, seed = seed)
+        expected = per_sentence_viterbi(crf, logits, mask)
+        for engine in ('loop', 'scan', 'sparse'):
+            assert torch.equal(crf.viterbi_tags(logits, mask, engine), expected)
+        predict, _ = crf.viterbi_topk(logits, mask, 3)
+        assert torch.equal(predict[:, 0], expected)
+
+def test_mask_wider_than_logits():
+    # a batch padded past its longest sentence, the encoder only returns the columns up to the longest one
+    crf = make_crf(('PER', 'LOC'))
+    logits, mask = random_batch(crf.num_tags, batch_size = 6, sen_len = 12, seed = 9)
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    wide_mask = torch.cat([mask, torch.zeros(6, 18, dtype = torch.bool)], dim = 1)
+    wide_tags = torch.cat([tags, torch.zeros(6, 18, dtype = torch.long)], dim = 1)
+    expected = per_sentence_viterbi(crf, logits, mask)
+    for engine in ('loop', 'scan', 'sparse'):
+        predict = crf.viterbi_tags(logits, wide_mask, engine)
+        assert predict.shape == wide_mask.shape
+        assert torch.equal(predict[:, :12], expected) and (predict[:, 12:] == 0).all()
+    predict, _ = crf.gated_viterbi_tags(logits, wide_mask)
+    assert torch.equal(predict[:, :12], expected) and predict.shape == wide_mask.shape
+    for engine in ('loop', 'scan', 'sparse', 'fused'):
+        assert torch.allclose(crf(logits, wide_tags, wide_mask, engine), crf(logits, tags, mask, engine))
+
+def test_log_likelihood_matches_per_sentence():
+    crf = make_crf(('PER', 'LOC')).double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 7, sen_len = 8, seed = 5)
+    logits = logits.double()
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    parameters = (crf.transitions, crf.start_transitions, crf.end_transitions)
+    expected = per_sentence_log_likelihood(logits, tags, mask, *parameters).sum()
+    expected_grads = torch.autograd.grad(expected, parameters)
+    for engine in ('loop', 'scan', 'fused'):
+        log_likelihood = crf(logits, tags, mask, engine)
+        assert torch.allclose(log_likelihood, expected)
+        for grad, expected_grad in zip(torch.autograd.grad(log_likelihood, parameters), expected_grads):
+            assert torch.allclose(grad, expected_grad)
+    constrained = crf._constrained_transitions(detach = False, forbidden = float('-inf'))
+    log_partition = dense_log_partition(logits, mask, *constrained)
+    assert torch.allclose(crf._input_likelihood(logits, mask, 'sparse'), log_partition)
+
+def test_marginals_match_per_sentence():
+    crf = make_crf(('PER',)).double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 5, sen_len = 5, seed = 6)
+    logits = logits.double()
+    marginals, pair_marginals = crf.marginals(logits, mask, pairwise = True)
+    expected, expected_pairs = per_sentence_marginals(logits, mask, *crf._constrained_transitions())
+    assert torch.allclose(marginals, expected)
+    assert torch.allclose(pair_marginals, expected_pairs)
+
+def test_semiring_scan_matches_loop():
+    crf = make_crf(('PER', 'LOC')).double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 6, sen_len = 11, seed = 7)
+    logits = logits.double()
+    parameters = (crf.transitions.detach(), crf.start_transitions.detach(), crf.end_transitions.detach())
+    alpha, beta, log_partition = forward_backward(logits, mask, *parameters)
+    scan_alpha, scan_beta = scan_forward_backward(logits, mask, *parameters)
+    assert torch.allclose(log_partition, dense_log_partition(logits, mask, *parameters))
+    for i, length in enumerate(mask.sum(1).tolist()):
+        # the scan keeps the alpha of a finished sentence, padded steps are skipped from both sides
+        assert torch.allclose(scan_alpha[i, :length], alpha[i, :length])
+        assert torch.allclose(scan_beta[i, :length], beta[i, :length])
+    matrices = parameters[0].view(1, 1, crf.num_tags, crf.num_tags) + logits[:, 1:].unsqueeze(2)
+    prefix = semiring_scan(matrices)
+    running = matrices[:, 0]
+    for i in range(1, matrices.size(1)):
+        running = torch.logsumexp(running.unsqueeze(3) + matrices[:, i].unsqueeze(1), 2)
+        assert torch.allclose(prefix[:, i], running)
+
+def test_packed_matches_per_sentence():
+    crf = make_crf(('PER', 'LOC')).double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 7, sen_len = 9, seed = 8)
+    logits = logits.double()
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    lengths = mask.sum(1)
+    emissions = pack_padded_sequence(logits, lengths, batch_first = True, enforce_sorted = False)
+    parameters = (crf.transitions, crf.start_transitions, crf.end_transitions)
+    expected = per_sentence_log_likelihood(logits, tags, mask, *parameters).sum()
+    assert torch.allclose(crf.forward_packed(emissions, tags), expected)
+    assert torch.allclose(crf(logits, tags, mask), expected)
+    predict = crf.viterbi_tags_packed(emissions)
+    assert torch.equal(predict, per_sentence_viterbi(crf, logits, mask)[:, : predict.size(1)])
+
+def test_viterbi_topk_matches_brute_force():
+    crf = make_crf()
+    logits, mask = random_batch(crf.num_tags, sen_len = 3)
+    k = 4
+    predict, scores = crf.viterbi_topk(logits, mask, k)
+    constrained = crf._constrained_transitions(forbidden = float('-inf'))
+    for i in range(logits.size(0)):
+        length = int(mask[i].sum())
+        paths, path_scores = all_path_scores(logits[i, :length], length, *constrained)
+        expected = path_scores.sort(descending = True).values
+        assert torch.allclose(scores[i], expected[:k])
+        for rank in range(k):
+            if torch.isinf(scores[i, rank]):
+                assert (predict[i, rank] == -1).all()
+                continue
+            # ties may come in either order, the returned path must have the returned score
+            assert torch.isclose(path_scores[(paths == predict[i, rank, :length]).all(1)].squeeze(), scores[i, rank])
+            assert (predict[i, rank, length:] == 0).all()
+
+def test_viterbi_topk_flags_missing_paths():
+    # one type and one token: only O and S-PER are valid single-token paths
+    crf = make_crf(('PER',))
+    logits = torch.randn(1, 1, crf.num_tags)
+    mask = torch.ones(1, 1, dtype = torch.bool)
+    predict, scores = crf.viterbi_topk(logits, mask, 5)
+    assert torch.isfinite(scores[0, :2]).all()
+    assert torch.isinf(scores[0, 2:]).all()
+    assert (predict[0, 2:] == -1).all()
+    valid = {crf.tag_dict[tag] for tag in predict[0, :2, 0].tolist()}
+    assert valid == {'O', 'S-PER'}
+
+def test_fused_gradcheck():
+    crf = make_crf(('PER',))
+    logits, mask = random_batch(crf.num_tags, batch_size = 3, sen_len = 4, seed = 1)
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    inputs = (logits.double().requires_grad_(), tags, mask, crf.transitions.detach().double().requires_grad_(),
+              crf.start_transitions.detach().double().requires_grad_(), crf.end_transitions.detach().double().requires_grad_())
+    assert torch.autograd.gradcheck(CRFLogLikelihood.apply, inputs)
+
+def test_fused_matches_loop():
+    crf = make_crf().double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 6, sen_len = 7, seed = 2)
+    logits = logits.double()
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    losses = {}
+    grads = {}
+    for engine in ('loop', 'fused'):
+        crf.zero_grad()
+        inputs = logits.clone().requires_grad_()
+        losses[engine] = crf(inputs, tags, mask, engine)
+        losses[engine].backward()
+        grads[engine] = [inputs.grad] + [parameter.grad.clone() for parameter in (crf.transitions, crf.start_transitions, crf.end_transitions)]
+    assert torch.allclose(losses['loop'], losses['fused'])
+    for loop_grad, fused_grad in zip(grads['loop'], grads['fused']):
+        assert torch.allclose(loop_grad, fused_grad)
+
+def test_weighted_loss_matches_loop():
+    # the rows padding a compiled batch have weight 0
+    crf = make_crf().double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 6, sen_len = 7, seed = 4)
+    logits = logits.double()
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    weights = torch.tensor([1., 0., 1., 0.5, 1., 0.], dtype = torch.float64)
+    inputs = (logits.clone().requires_grad_(), tags, mask, crf.transitions.detach().clone().requires_grad_(),
+              crf.start_transitions.detach().clone().requires_grad_(), crf.end_transitions.detach().clone().requires_grad_(), weights)
+    assert torch.autograd.gradcheck(CRFLogLikelihood.apply, inputs)
+    losses = {}
+    grads = {}
+    for engine in ('loop', 'scan', 'fused'):
+        crf.zero_grad()
+        inputs = logits.clone().requires_grad_()
+        losses[engine] = crf(inputs, tags, mask, engine, weights)
+        losses[engine].backward()
+        grads[engine] = [inputs.grad] + [parameter.grad.clone() for parameter in (crf.transitions, crf.start_transitions, crf.end_transitions)]
+    keep = weights > 0
+    assert torch.allclose(losses['loop'], (crf(logits[keep], tags[keep], mask[keep], 'loop', weights[keep])))
+    assert (grads['loop'][0][~keep] == 0).all()
+    for engine in ('scan', 'fused'):
+        assert torch.allclose(losses['loop'], losses[engine])
+        for loop_grad, grad in zip(grads['loop'], grads[engine]):
+            assert torch.allclose(loop_grad, grad)
+
+def test_fused_skips_beta_without_grad(monkeypatch):
+    crf = make_crf()
+    logits, mask = random_batch(crf.num_tags)
+    tags = torch.randint(0, crf.num_tags, mask.shape) * mask.long()
+    calls = []
+    def recorded_forward_backward(*args):
+        calls.append(args[5:])
+        return forward_backward(*args)
+    monkeypatch.setattr(crf_module, 'forward_backward', recorded_forward_backward)
+    with torch.no_grad():
+        validation = crf(logits, tags, mask, 'fused')
+    assert calls == []
+    # no input needs a gradient
+    fused = CRFLogLikelihood.apply(logits, tags, mask, crf.transitions.detach(), crf.start_transitions.detach(), crf.end_transitions.detach())
+    assert calls == [(False,)]
+    assert torch.allclose(validation, crf(logits, tags, mask, 'loop'), atol = 1e-4)
+    assert torch.isfinite(fused)
+
+def test_sparse_matches_constrained_dense():
+    # the sparse engine is the dense lattice with -inf for forbidden transitions, not the unconstrained loop engine
+    crf = make_crf(('PER', 'LOC', 'ORG')).double()
+    logits, mask = random_batch(crf.num_tags, batch_size = 6, sen_len = 8, seed = 3)
+    logits = logits.double()
+    log_partition = dense_log_partition(logits, mask, *crf._constrained_transitions(forbidden = float('-inf')))
+    assert torch.allclose(crf._input_likelihood(logits, mask, 'sparse'), log_partition)
+    assert not torch.allclose(crf._input_likelihood(logits, mask, 'loop'), log_partition)
+    assert torch.equal(crf.viterbi_tags(logits, mask, 'sparse'), crf.viterbi_tags(logits, mask, 'loop'))
@@ -0,0 +1,95 @@
+import os
+import random
+
+from LexiconEmbedding import LexiconVocab
+
+lexicon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicon.txt')
+
+def scan_sentence_to_typeid(lexicon_vocab, text, sen_len, rules):
+    '''
+    the text.find scan over every lexicon word, the reference of the trie lookup
+    '''
+    type_ids = [0 for _ in range(sen_len)]
+    marked = [False for _ in range(sen_len)]
+    for word in lexicon_vocab.word_list:
+        base = 0
+        pos = text.find(word)
+        while pos != -1:
+            start_pos = base + pos
+            end_pos = start_pos + len(word)
+            if not marked[start_pos] and not (end_pos < sen_len and marked[end_pos]):
+                type_id = lexicon_vocab.word_to_typeid[word]
+                for rule in rules:
+                    type, gap, chars, new_type = rule
+                    if type != lexicon_vocab.word_to_type[word]:
+                        continue
+                    for char in chars:
+                        char_pos = text[end_pos:].find(char)
+                        if char_pos != -1 and char_pos < gap:
+                            end_pos += char_pos + len(char)
+                            type_id = lexicon_vocab.type_to_id[new_type]
+                            break
+                for i in range(start_pos, end_pos):
+                    type_ids[i] = type_id
+                    marked[i] = True
+            base = end_pos
+            pos = text[base:].find(word)
+    return type_ids
+
+def random_sentences(lexicon_vocab, num_sentences = 200, seed = 0):
+    '''
+    sentences of lexicon words, pieces of words, rule suffixes and filler characters
+    '''
+    rng = random.Random(seed)
+    fillers = ['，', '。', '患', '者', '癌', '肿瘤', '切除术', '示', '行']
+    sentences = []
+    for _ in range(num_sentences):
+        pieces = []
+        for _ in range(rng.randint(1, 8)):
+            word = rng.choice(lexicon_vocab.word_list)
+            choice = rng.random()
+            if choice < 0.5:
+                pieces.append(word)
+            elif choice < 0.7:
+                pieces.append(word[: rng.randint(1, len(word))])
+            else:
+                pieces.append(rng.choice(fillers))
+        sentences.append(''.join(pieces))
+    # overlapping occurrences of the same word and a word ending the longest sentence
+    word = lexicon_vocab.word_list[-1]
+    sentences.append(word * 3)
+    sentences.append(word[:1] * 5)
+    # words listed twice in lexicon.txt
+    sentences.append('腹膜反折上2CM处直肠癌根治DIXON术')
+    sentences.append('肠壁一站（1/5个）淋巴结直肠多发息肉内镜下切除术')
+    return sentences
+
+def test_trie_matches_find_scan():
+    lexicon_vocab = LexiconVocab(dict_path = lexicon_path)
+    sentences = random_sentences(lexicon_vocab)
+    sen_len = max([len(text) for text in sentences])
+    for use_rule in (False, True):
+        rules = lexicon_vocab.rules if use_rule else []
+        batch_ids = lexicon_vocab.map_batch_to_typeid([list(text) for text in sentences], use_rule)
+        for text, type_ids in zip(sentences, batch_ids):
+            assert type_ids == scan_sentence_to_typeid(lexicon_vocab, text, sen_len, rules)
+    assert any(any(type_ids) for type_ids in batch_ids)
+
+def test_duplicated_words_keep_first_position():
+    lexicon_vocab = LexiconVocab(dict_path = lexicon_path)
+    first = {}
+    for i, word in enumerate(lexicon_vocab.word_list):
+        first.setdefault(word, i)
+    assert len(first) < len(lexicon_vocab.word_list)
+    assert lexicon_vocab.word_rank == first
+    text = '腹膜反折上2CM处直肠癌根治DIXON术'
+    assert lexicon_vocab.map_sentence_to_typeid(text, len(text), False) == scan_sentence_to_typeid(lexicon_vocab, text, len(text), [])
+
+def test_index_rebuilt_for_pickled_vocab():
+    lexicon_vocab = LexiconVocab(dict_path = lexicon_path)
+    text = lexicon_vocab.word_list[0]
+    expected = lexicon_vocab.map_sentence_to_typeid(text, len(text), False)
+    # vocabs pickled before the index was added have no trie
+    del lexicon_vocab.trie
+    assert lexicon_vocab.map_sentence_to_typeid(text, len(text), False) == expected
+    assert all(expected)
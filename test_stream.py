@@ -0,0 +1,76 @@
+import random
+import string
+import torch
+
+from BiLSTM_CRF import BiLSTM_CRF
+from ConllData import WordVocab, padding_chars
+from StreamTagger import StreamTagger
+from TagVocab import TagVocab
+
+def make_vocab(words):
+    '''
+    WordVocab of the given words, without reading CoNLL2003 and the pretrained table
+    '''
+    vocab = WordVocab.__new__(WordVocab)
+    vocab.OOV_TAG = '<OOV>'
+    vocab.PAD_TAG = '<PAD>'
+    vocab.out_of_core = False
+    vocab.word_list = [vocab.PAD_TAG, vocab.OOV_TAG] + sorted(set(word.lower() for word in words))
+    vocab.word_to_ix = {word: i for i, word in enumerate(vocab.word_list)}
+    vocab.char_to_ix = {vocab.PAD_TAG: 0, vocab.OOV_TAG: 1}
+    for char in string.ascii_letters:
+        vocab.char_to_ix[char] = len(vocab.char_to_ix)
+    return vocab
+
+def make_tagger(words, seed = 0):
+    torch.manual_seed(seed)
+    vocab = make_vocab(words)
+    tag_vocab = TagVocab(['PER', 'LOC'])
+    model = BiLSTM_CRF(vocab, tag_vocab, 16, 16, 0, 0, 0, 16, 1, 1, 'cpu',
+                       use_word = True, use_char = True, use_lm = False, use_crf = True, use_cnn = True, use_lexicon = False,
+                       use_pretrained_word = False, use_pretrained_char = False)
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.normal_()
+    return model.eval(), vocab
+
+def random_words(num_words, seed = 0):
+    # short words and a few longer than the 16 chars of ConllDataset
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(1, 6))) for _ in range(num_words)]
+    for i in range(0, num_words, 7):
+        words[i] = ''.join(rng.choice(string.ascii_letters) for _ in range(20))
+    return words
+
+def full_sentence(model, vocab, words):
+    '''
+    inputs of the whole document as one sentence, padded as ConllDataset does
+    '''
+    word_ids = torch.tensor([vocab.map_word(words, dim = 2)], dtype = torch.long)
+    word_mask = torch.ones_like(word_ids, dtype = torch.bool)
+    char_ids, _ = padding_chars(vocab.map_char(words, dim = 2), 16)
+    char_ids = torch.tensor([char_ids], dtype = torch.long)
+    return [words], word_ids, word_mask, char_ids, None
+
+def test_encode_pads_chars_as_conll():
+    words = random_words(30)
+    model, vocab = make_tagger(words)
+    tagger = StreamTagger(model, vocab, window = 64, context = 8)
+    with torch.no_grad():
+        expected, _ = model._get_emissions(*full_sentence(model, vocab, words))
+        # a window without long words is padded to 16 chars as well
+        short = [word for word in words if len(word) <= 6]
+        expected_short, _ = model._get_emissions(*full_sentence(model, vocab, short))
+    assert torch.allclose(tagger.encode(words), expected[0], atol = 1e-5)
+    assert torch.allclose(tagger.encode(short), expected_short[0], atol = 1e-5)
+
+def test_stream_matches_full_viterbi_after_flush():
+    words = random_words(50, seed = 1)
+    model, vocab = make_tagger(words, seed = 1)
+    with torch.no_grad():
+        expected = model(*full_sentence(model, vocab, words))[0].tolist()
+    # the window covers the document and the lag is longer than it, every tag is committed by the final flush
+    tagger = StreamTagger(model, vocab, window = 128, context = 16, lag = 64)
+    streamed = list(tagger.tag(words))
+    assert [word for word, _ in streamed] == words
+    assert [tag for _, tag in streamed] == expected